@@ -9,19 +9,25 @@
 # the License, or (at your option) any later version.
 #
 
+import sys
 import os
 from os.path import exists, join, isdir
 
 import stat
+import time
+import threading
 
 import shutil
 import simplejson
 
+from StringIO import StringIO
+
 from paths import Paths
 
 from dirindex import read_paths
 from changes import whatchanged
 from pkgman import Packages
+from threadpool import ThreadPool
 
 import mysql
 import pgsql
@@ -104,11 +110,11 @@ class Backup:
         fh.close()
 
     def _write_whatchanged(self, dest, dest_olist, dirindex, dirindex_conf,
-                           overrides=[]):
+                           overrides=[], cache=None):
         paths = read_paths(file(dirindex_conf))
         paths += overrides
 
-        changes = whatchanged(dirindex, paths)
+        changes = whatchanged(dirindex, paths, cache=cache)
         changes.sort(lambda a,b: cmp(a.path, b.path))
 
         changes.tofile(dest)
@@ -122,8 +128,7 @@ class Backup:
             actions = list(changes.deleted(optimized=False)) + list(changes.statfixes(optimized=False))
             actions.sort(lambda a,b: cmp(a.args[0], b.args[0]))
 
-            umask = os.umask(0)
-            os.umask(umask)
+            umask = self.umask
 
             for action in actions:
                 if action.func is os.chmod:
@@ -143,6 +148,92 @@ class Backup:
                 for path in olist:
                     self._log("  " + path)
 
+    def _backup_mysql(self, extras, conf):
+        try:
+            if mysql.MysqlService.is_running():
+                self._log("\n" + fmt_title("Serializing MySQL database to " + extras.myfs, '-'))
+                mysql.backup(extras.myfs, extras.etc.mysql, self.database_threads,
+                             limits=conf.overrides.mydb,
+                             callback=mysql.cb_print(self._output()) if self.verbose else None,
+                             tsv=self.mysql_tsv, compress=self.mysql_compress,
+                             consistent=self.mysql_lock,
+                             cache=self.myfs_cache,
+                             segment_size=self.mysql_segment_size * 1024 * 1024)
+
+        except mysql.Error, e:
+            print >> sys.stderr, "warning: " + str(e)
+
+    def _backup_pgsql(self, extras, conf):
+        try:
+            if pgsql.PgsqlService.is_running():
+                self._log("\n" + fmt_title("Serializing PgSQL databases to " + extras.pgfs, '-'))
+                pgsql.backup(extras.pgfs, conf.overrides.pgdb,
+                             callback=pgsql.cb_print(self._output()) if self.verbose else None,
+                             threads=self.database_threads, jobs=self.pgsql_jobs,
+                             cache=self.pgfs_cache)
+        except pgsql.Error, e:
+            print >> sys.stderr, "warning: " + str(e)
+
+    def _run_stages(self, stages):
+        """Run (name, func) <stages> and record how long each took.
+
+        If pipelined, stages run concurrently. The output of each stage is
+        then buffered and printed in order once all stages are done. If a
+        stage fails the others still run to completion, then the error of
+        the first failed stage is raised.
+        """
+        elapsed = {}
+        def run(name, func):
+            started = time.time()
+            try:
+                func()
+            finally:
+                elapsed[name] = time.time() - started
+
+        try:
+            if not self.pipelined or len(stages) < 2:
+                for name, func in stages:
+                    run(name, func)
+                return
+
+            outputs = [ StringIO() for stage in stages ]
+
+            # stages catch their own errors, otherwise the pool would skip
+            # stages that hadn't started yet
+            errors = {}
+            def run_buffered(output, name, func):
+                self._local.output = output
+                try:
+                    run(name, func)
+                except:
+                    errors[name] = sys.exc_info()
+
+            pool = ThreadPool(len(stages))
+            try:
+                for output, (name, func) in zip(outputs, stages):
+                    pool.submit(run_buffered, output, name, func)
+            finally:
+                try:
+                    pool.join()
+                finally:
+                    for output in outputs:
+                        sys.stdout.write(output.getvalue())
+
+            if errors:
+                failed = [ name for name, func in stages if name in errors ]
+                completed = [ name for name, func in stages if name not in errors ]
+                print >> sys.stderr, "failed stages: %s (completed: %s)" % \
+                        (", ".join(failed), ", ".join(completed) or "none")
+
+                exc_type, exc_value, exc_tb = errors[failed[0]]
+                raise exc_type, exc_value, exc_tb
+
+        finally:
+            self.timings += [ (name, elapsed[name]) for name, func in stages if name in elapsed ]
+
+    def fmt_timings(self):
+        return ", ".join([ "%s %.3fs" % (name, elapsed) for name, elapsed in self.timings ])
+
     def _create_extras(self, extras, profile, conf):
         os.mkdir(extras.path)
         os.chmod(extras.path, 0700)
@@ -162,44 +253,58 @@ class Backup:
         if not conf.skip_packages or not conf.skip_files:
             self._log("\n" + fmt_title("Comparing current system state to the base state in the backup profile", '-'))
 
+        stages = []
         if not conf.skip_packages and exists(profile.packages):
-            self._write_new_packages(extras.newpkgs, profile.packages)
+            stages.append(('packages', lambda: self._write_new_packages(extras.newpkgs, profile.packages)))
 
         if not conf.skip_files:
             # support empty profiles
             dirindex = profile.dirindex if exists(profile.dirindex) else "/dev/null"
             dirindex_conf = profile.dirindex_conf if exists(profile.dirindex_conf) else "/dev/null"
 
-            self._write_whatchanged(extras.fsdelta, extras.fsdelta_olist,
-                                    dirindex, dirindex_conf,
-                                    conf.overrides.fs)
+            stages.append(('files', lambda: self._write_whatchanged(extras.fsdelta, extras.fsdelta_olist,
+                                                                    dirindex, dirindex_conf,
+                                                                    conf.overrides.fs,
+                                                                    self.dirindex_cache)))
 
         if not conf.skip_database:
+            stages.append(('mysql', lambda: self._backup_mysql(extras, conf)))
+            stages.append(('pgsql', lambda: self._backup_pgsql(extras, conf)))
 
-            try:
-                if mysql.MysqlService.is_running():
-                    self._log("\n" + fmt_title("Serializing MySQL database to " + extras.myfs, '-'))
-                    mysql.backup(extras.myfs, extras.etc.mysql,
-                                 limits=conf.overrides.mydb, callback=mysql.cb_print()) if self.verbose else None
-
-            except mysql.Error:
-                pass
+        self._run_stages(stages)
 
-            try:
-                if pgsql.PgsqlService.is_running():
-                    self._log("\n" + fmt_title("Serializing PgSQL databases to " + extras.pgfs, '-'))
-                    pgsql.backup(extras.pgfs, conf.overrides.pgdb, callback=pgsql.cb_print() if self.verbose else None)
-            except pgsql.Error:
-                pass
+    def _output(self):
+        """file the current stage prints to"""
+        return getattr(self._local, 'output', None) or sys.stdout
 
     def _log(self, s=""):
         if self.verbose:
-            print s
+            print >> self._output(), s
 
     def __init__(self, profile, overrides, 
-                 skip_files=False, skip_packages=False, skip_database=False, resume=False, verbose=True, extras_root="/"):
+                 skip_files=False, skip_packages=False, skip_database=False, resume=False, verbose=True, extras_root="/",
+                 dirindex_cache=None, database_threads=1, mysql_tsv=False, myfs_cache=None,
+                 mysql_compress=None, mysql_segment_size=0, pgsql_jobs=1, pgfs_cache=None,
+                 pipelined=False, mysql_lock=True):
 
         self.verbose = verbose
+        self.dirindex_cache = dirindex_cache
+        self.database_threads = database_threads
+        self.mysql_tsv = mysql_tsv
+        self.myfs_cache = myfs_cache
+        self.mysql_compress = mysql_compress
+        self.mysql_lock = mysql_lock
+        self.mysql_segment_size = mysql_segment_size
+        self.pgsql_jobs = pgsql_jobs
+        self.pgfs_cache = pgfs_cache
+        self.pipelined = pipelined
+
+        self.timings = []
+        self._local = threading.local()
+
+        # stages running concurrently mustn't change the umask
+        self.umask = os.umask(0)
+        os.umask(self.umask)
 
         if not profile:
             raise self.Error("can't backup without a profile")
@@ -14,11 +14,15 @@ from os.path import *
 
 import types
 
+import dirindex
 from dirindex import DirIndex
 from pathmap import PathMap
 
 import stat
 import errno
+import threading
+
+from threadpool import ThreadPool
 
 import pwd
 import grp
@@ -133,19 +137,31 @@ def mkdir(path):
         if e.errno != errno.EEXIST:
             raise
 
-class Changes(list):
+def _lstat(path):
+    """Like os.lstat() but returns None if path doesn't exist"""
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+class ChangesBase:
     """
-    A list of Change instances, which we can load from a file and write
-    back to a file.
+    Base class for iterables of Change instances (see Changes and
+    ChangesFile), which we can write to a file.
 
     The smarts is in statfixes() and deleted() methods which compare the
-    list of changes to the current filesystem and yield Action() instances.
+    changes to the current filesystem and yield Action() instances.
 
     Action()s can be printed (e.g., for simulation or verbosity) or called
     to run the operation that needs to be performed.
 
     """
     class Action:
+        NAMES = { os.lchown: 'chown',
+                  os.chmod: 'chmod',
+                  os.remove: 'rm',
+                  mkdir: 'mkdir' }
+
         def __init__(self, func, *args):
             self.func = func
             self.args = args
@@ -153,6 +169,14 @@ class Changes(list):
         def __call__(self):
             return self.func(*self.args)
 
+        def name(self):
+            return self.NAMES.get(self.func, self.func.__name__)
+        name = property(name)
+
+        def path(self):
+            return self.args[0]
+        path = property(path)
+
         def __str__(self):
             func = self.func
             args = self.args
@@ -170,27 +194,31 @@ class Changes(list):
                 path, = args
                 return "mkdir -p " + path
 
-    def __add__(self, other):
-        cls = type(self)
-        return cls(list.__add__(self, other))
-
-    @classmethod
-    def fromfile(cls, f, paths=None):
+    @staticmethod
+    def iterfile(f, paths=None):
+        """Parse fsdelta file <f> ('-' for stdin) line by line and yield
+        Change()s, filtered by <paths> if specified"""
         if f == '-':
             fh = sys.stdin
         else:
             fh = file(f)
 
-        changes = [ Change.parse(line) for line in fh.readlines() ]
-        if paths:
-            pathmap = PathMap(paths)
-            changes = [ change for change in changes
-                        if change.path in pathmap ]
+        pathmap = PathMap(paths) if paths else None
+        for line in fh:
+            change = Change.parse(line)
+            if pathmap is None or change.path in pathmap:
+                yield change
 
-        return cls(changes)
+    @staticmethod
+    def writefile(f, changes):
+        """Write iterable of Change()s to fsdelta file <f> as we go"""
+        fh = file(f, "w")
+        for change in changes:
+            fh.write(str(change) + "\n")
+        fh.close()
 
     def tofile(self, f):
-        file(f, "w").writelines((str(change) + "\n" for change in self))
+        self.writefile(f, self)
 
     def deleted(self, optimized=True):
         for change in self:
@@ -198,10 +226,8 @@ class Changes(list):
                 continue
 
             if optimized:
-                if not lexists(change.path):
-                    continue
-
-                if not islink(change.path) and isdir(change.path):
+                st = _lstat(change.path)
+                if st is None or stat.S_ISDIR(st.st_mode):
                     continue
 
             yield self.Action(os.remove, change.path)
@@ -218,7 +244,10 @@ class Changes(list):
 
         for change in self:
 
-            if not optimized or not lexists(change.path):
+            # one lstat per change: existence, ownership, mode and type
+            st = _lstat(change.path) if optimized else None
+
+            if not optimized or st is None:
                 # backwards compat: old backups only stored IMODE in fsdelta, so we assume S_ISDIR
                 if change.OP == 's' and (stat.S_IMODE(change.mode) == change.mode or stat.S_ISDIR(change.mode)):
                     yield self.Action(mkdir, change.path)
@@ -236,7 +265,9 @@ class Changes(list):
                change.uid not in uidmap and change.gid not in gidmap:
                 continue
 
-            st = os.lstat(change.path)
+            if st is None:
+                st = os.lstat(change.path)
+
             if change.OP in ('s', 'o'):
                 if not optimized or \
                    (st.st_uid != uidmap[change.uid] or \
@@ -247,27 +278,168 @@ class Changes(list):
 
             if change.OP == 's':
                 if not optimized or \
-                    (not islink(change.path) and \
+                    (not stat.S_ISLNK(st.st_mode) and \
                      stat.S_IMODE(st.st_mode) != stat.S_IMODE(change.mode)):
                     yield self.Action(os.chmod, change.path, stat.S_IMODE(change.mode))
 
-def whatchanged(di_path, paths):
-    """Compared current filesystem with a saved dirindex from before.
-       Returns a Changes() list."""
+class Changes(list, ChangesBase):
+    """
+    A list of Change instances, which we can load from a file and write
+    back to a file.
+    """
+    def __add__(self, other):
+        cls = type(self)
+        return cls(list.__add__(self, other))
+
+    @classmethod
+    def fromfile(cls, f, paths=None):
+        return cls(cls.iterfile(f, paths))
+
+class ChangesFile(ChangesBase):
+    """
+    Streaming alternative to Changes.fromfile() for large fsdeltas.
+
+    Change()s are parsed from the file and filtered each time we iterate,
+    so memory use is constant. Iterating stdin ('-') only works once.
+
+    Usage example::
+
+        changes = ChangesFile(path, limits)
+        for action in changes.statfixes():
+            action()
+    """
+    def __init__(self, path, paths=None):
+        self.path = path
+        self.paths = paths
+
+    def __iter__(self):
+        return self.iterfile(self.path, self.paths)
+
+class Executor:
+    """Execute Changes.Action()s, optionally with a pool of threads.
+
+    Actions are consumed as a stream. mkdir actions run immediately, in
+    order, so a directory exists before any later action touches it or its
+    contents. Consecutive runs of other actions with the same parent
+    directory are batched and each batch runs in order in a single thread,
+    which preserves the order of actions on the same path (e.g., chown
+    before chmod) and keeps each thread working in one directory at a time.
+
+    Executed actions are counted by name (e.g., 'chown', 'chmod') in
+    self.counters. If a callback is given it's called with each action
+    after it has been executed.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, threads=1, callback=None):
+        self.threads = threads
+        self.callback = callback
+
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def _run(self, action):
+        action()
+
+        self.lock.acquire()
+        try:
+            self.counters[action.name] = self.counters.get(action.name, 0) + 1
+            if self.callback:
+                self.callback(action)
+        finally:
+            self.lock.release()
+
+    def _run_group(self, actions):
+        for action in actions:
+            self._run(action)
 
-    di_saved = DirIndex(di_path)
-    di_fs = DirIndex()
-    di_fs.walk(*paths)
+    def _batches(self, actions):
+        batch = []
+        batch_dir = None
 
-    new, edited, statfix = di_saved.diff(di_fs)
-    changes = Changes()
+        for action in actions:
+            if action.func is mkdir:
+                if batch:
+                    yield batch
+                    batch = []
 
-    changes += [ Change.Overwrite(path) for path in new + edited ]
-    changes += [ Change.Stat(path) for path in statfix ]
+                yield [ action ]
+                continue
+
+            # never split actions on the same path between batches
+            dir = dirname(action.path)
+            if batch and (dir != batch_dir or
+                          (len(batch) >= self.BATCH_SIZE and
+                           action.path != batch[-1].path)):
+                yield batch
+                batch = []
+
+            batch.append(action)
+            batch_dir = dir
+
+        if batch:
+            yield batch
+
+    def __call__(self, actions):
+        if self.threads < 2:
+            for action in actions:
+                self._run(action)
+            return
+
+        # bounded queue: don't read ahead of the workers too far
+        pool = ThreadPool(self.threads, maxsize=self.threads * 2)
+        try:
+            for batch in self._batches(actions):
+                if batch[0].func is mkdir:
+                    self._run(batch[0])
+                else:
+                    pool.submit(self._run_group, batch)
+        finally:
+            pool.join()
+
+    def fmt_counters(self):
+        return ", ".join([ "%s: %d" % (name, self.counters[name])
+                           for name in sorted(self.counters) ])
+
+def iterwhatchanged(di_path, paths, threads=None, cache=None):
+    """Compare current filesystem with a saved dirindex from before.
+       Yields Change() instances sorted by path.
+
+       The saved dirindex and the filesystem are merged as two sorted
+       streams so memory use doesn't grow with the size of the tree,
+       unless we're scanning the filesystem with multiple threads.
+
+       If <cache> is a path, directory listings are reused from and saved
+       to it (see dirindex.ListingCache)."""
 
-    di_saved.prune(*paths)
-    deleted = set(di_saved) - set(di_fs)
-    changes += [ Change.Deleted(path) for path in deleted ]
+    if cache:
+        cache = dirindex.ListingCache(cache)
 
-    return changes
+    if threads and threads > 1:
+        di_fs = DirIndex()
+        di_fs.walk(*paths, threads=threads, cache=cache)
+        fs = ( di_fs[path] for path in sorted(di_fs) )
+    else:
+        fs = dirindex.walk_sorted(*paths, cache=cache)
+
+    pathmap = PathMap(paths)
+    for kind, rec in dirindex.iterdiff(dirindex.iterfile(di_path), fs):
+        if kind in ('new', 'edited'):
+            yield Change.Overwrite(rec.path, rec.uid, rec.gid)
+
+        elif kind == 'stat':
+            yield Change.Stat(rec.path, rec.uid, rec.gid, rec.mod)
+
+        elif kind == 'deleted':
+            if rec.path in pathmap:
+                yield Change.Deleted(rec.path)
+
+    # only reached if the whole tree was scanned
+    if cache:
+        cache.save()
+
+def whatchanged(di_path, paths, threads=None, cache=None):
+    """Compared current filesystem with a saved dirindex from before.
+       Returns a Changes() list."""
 
+    return Changes(iterwhatchanged(di_path, paths, threads, cache))
@@ -64,6 +64,51 @@ Configurable options:
     --s3-parallel-uploads=N        Number of parallel volume chunk uploads
                                    default: $CONF_S3_PARALLEL_UPLOADS
 
+    --database-threads=N           Number of concurrent database dump processes
+                                   default: $CONF_DATABASE_THREADS
+
+    --dirindex-cache               Reuse listings of directories unchanged since
+                                   the previous backup when comparing the
+                                   filesystem. This only saves reading those
+                                   directories: every file is still checked, so
+                                   the comparison still takes time in proportion
+                                   to the number of files. All listings are kept
+                                   in memory
+
+    --pipelined                    Compare the filesystem and serialize MySQL and
+                                   PgSQL concurrently, rather than one after the
+                                   other
+
+    --mysql-tsv                    Save MySQL table rows as tab separated data
+                                   which restores with LOAD DATA LOCAL INFILE
+
+    --mysql-incremental            Link rows of MySQL tables unchanged since the
+                                   previous backup instead of dumping them again
+
+    --mysql-no-lock                Don't take a global read lock (FLUSH TABLES WITH
+                                   READ LOCK) to start concurrent or incremental
+                                   MySQL dumps from the same point in time. Waiting
+                                   for the lock can stall the server behind a long
+                                   query. Without it each mysqldump has its own
+                                   snapshot (conf: mysql-lock no)
+
+    --mysql-compress=FORMAT        Compress MySQL table rows
+                                   format := none | gzip | zstd
+                                   default: $CONF_MYSQL_COMPRESS
+
+    --mysql-segment-size=MB        Split MySQL table rows into segments of MB
+                                   (uncompressed) which restore concurrently
+                                   default: $CONF_MYSQL_SEGMENT_SIZE (don't split)
+
+    --pgsql-jobs=N                 Number of concurrent pg_dump jobs per PostgreSQL
+                                   database. More than 1 dumps in directory format
+                                   default: $CONF_PGSQL_JOBS
+
+    --pgsql-incremental            Carry PostgreSQL databases without writes since
+                                   the previous backup forward instead of dumping
+                                   them again. Writes are told by statistics
+                                   counters, which may miss some (best effort)
+
     --full-backup FREQUENCY        Time frequency of full backup
                                    default: $CONF_FULL_BACKUP
 
@@ -168,6 +213,10 @@ def usage(e=None):
                                     CONF_VOLSIZE=conf.volsize,
                                     CONF_FULL_BACKUP=conf.full_backup,
                                     CONF_S3_PARALLEL_UPLOADS=conf.s3_parallel_uploads,
+                                    CONF_DATABASE_THREADS=conf.database_threads,
+                                    CONF_MYSQL_COMPRESS=conf.mysql_compress or 'none',
+                                    CONF_MYSQL_SEGMENT_SIZE=conf.mysql_segment_size,
+                                    CONF_PGSQL_JOBS=conf.pgsql_jobs,
                                     LOGFILE=PATH_LOGFILE)
     sys.exit(1)
 
@@ -201,7 +250,11 @@ def main():
                                         'logfile=',
                                         'simulate', 'quiet',
                                         'force-profile=', 'secretfile=', 'address=',
-                                        'volsize=', 's3-parallel-uploads=', 'full-backup='])
+                                        'volsize=', 's3-parallel-uploads=', 'full-backup=',
+                                        'dirindex-cache',
+                                        'database-threads=', 'mysql-tsv', 'mysql-incremental', 'mysql-no-lock', 'mysql-compress=',
+                                        'mysql-segment-size=', 'pgsql-jobs=', 'pgsql-incremental',
+                                        'pipelined'])
     except getopt.GetoptError, e:
         usage(e)
 
@@ -272,6 +325,36 @@ def main():
         elif opt == '--full-backup':
             conf.full_backup = val
 
+        elif opt == '--dirindex-cache':
+            conf.dirindex_cache = True
+
+        elif opt == '--database-threads':
+            conf.database_threads = val
+
+        elif opt == '--mysql-tsv':
+            conf.mysql_tsv = True
+
+        elif opt == '--mysql-incremental':
+            conf.mysql_incremental = True
+
+        elif opt == '--mysql-no-lock':
+            conf.mysql_lock = False
+
+        elif opt == '--mysql-compress':
+            conf.mysql_compress = val
+
+        elif opt == '--mysql-segment-size':
+            conf.mysql_segment_size = val
+
+        elif opt == '--pgsql-jobs':
+            conf.pgsql_jobs = val
+
+        elif opt == '--pgsql-incremental':
+            conf.pgsql_incremental = True
+
+        elif opt == '--pipelined':
+            conf.pipelined = True
+
         elif opt == '--logfile':
             if not is_writeable(val):
                 fatal("logfile '%s' is not writeable" % val)
@@ -440,7 +523,17 @@ def main():
             b = backup.Backup(registry.profile,
                               conf.overrides,
                               conf.backup_skip_files, conf.backup_skip_packages, conf.backup_skip_database,
-                              opt_resume, True, dump_path if dump_path else "/")
+                              opt_resume, True, dump_path if dump_path else "/",
+                              dirindex_cache=registry.path.dirindex_cache if conf.dirindex_cache else None,
+                              database_threads=conf.database_threads,
+                              mysql_tsv=conf.mysql_tsv,
+                              myfs_cache=registry.path.myfs_cache if conf.mysql_incremental else None,
+                              mysql_compress=conf.mysql_compress,
+                              mysql_lock=conf.mysql_lock,
+                              mysql_segment_size=conf.mysql_segment_size,
+                              pgsql_jobs=conf.pgsql_jobs,
+                              pgfs_cache=registry.path.pgfs_cache if conf.pgsql_incremental else None,
+                              pipelined=conf.pipelined)
 
             hooks.backup.inspect(b.extras_paths.path)
 
@@ -460,8 +553,13 @@ def main():
                                                                else None,
                                               excludes=[ '**' ])
 
+                started = time.time()
                 uploader('/', target, force_cleanup=not b.resume, dry_run=opt_simulate, debug=opt_debug,
                          log=_print)
+                b.timings.append(('upload', time.time() - started))
+
+            if b.timings:
+                print "BACKUP STAGE TIMINGS: " + b.fmt_timings() + "\n"
 
             hooks.backup.post()
 
@@ -74,6 +74,9 @@ Options:
     --root=PATH     Use this as the root path, instead of /
                     This is useful for generating backup profiles for chroot filesystems
 
+    --threads=N     Scan directories for the dirindex in parallel with N threads
+                    This is useful for large trees on network or SAN storage
+
 
 Usage examples:
 
@@ -116,13 +119,13 @@ def fatal(e):
 class ProfileGenerator:
 
     @staticmethod
-    def _get_dirindex(path_dirindex_conf, path_rootfs):
+    def _get_dirindex(path_dirindex_conf, path_rootfs, threads=None):
         paths = dirindex.read_paths(file(path_dirindex_conf))
         paths = [ re.sub(r'^(-?)', '\\1' + path_rootfs, path) 
                   for path in paths ]
 
         tmp = TempFile()
-        dirindex.create(tmp.path, paths)
+        dirindex.create(tmp.path, paths, threads)
 
         filtered = [ re.sub(r'^' + path_rootfs, '', line) 
                             for line in file(tmp.path).readlines() ]
@@ -156,7 +159,7 @@ class ProfileGenerator:
         packages.sort()
         return packages
 
-    def __init__(self, conf_paths, path_output, rootfs="/", packages=True, dirindex=True):
+    def __init__(self, conf_paths, path_output, rootfs="/", packages=True, dirindex=True, threads=None):
 
         paths = ProfilePaths(path_output)
 
@@ -165,7 +168,7 @@ class ProfileGenerator:
                                              if conf_paths else "")
 
         if dirindex:
-            di = self._get_dirindex(paths.dirindex_conf, rootfs)
+            di = self._get_dirindex(paths.dirindex_conf, rootfs, threads)
             file(paths.dirindex, "w").write(di)
 
         if packages:
@@ -198,6 +201,7 @@ def main():
     try:
         opts, args = getopt.gnu_getopt(sys.argv[1:], 'fh', ['force', 'help', 
                                                             'root=',
+                                                            'threads=',
                                                             'no-dirindex', 
                                                             'no-packages'])
     except getopt.GetoptError, e:
@@ -207,6 +211,7 @@ def main():
     opt_dirindex = True
     opt_packages = True
     opt_root = "/"
+    opt_threads = None
 
     for opt, val in opts:
         if opt in ('-h', '--help'):
@@ -224,6 +229,12 @@ def main():
         if opt == '--root':
             opt_root = val
 
+        if opt == '--threads':
+            try:
+                opt_threads = int(val)
+            except ValueError:
+                usage("illegal number of threads '%s'" % val)
+
     if not args:
         usage()
 
@@ -247,7 +258,8 @@ def main():
     except Error, e:
         fatal(e)
 
-    profile = ProfileGenerator(conf_paths, path_output, opt_root, packages=opt_packages, dirindex=opt_dirindex)
+    profile = ProfileGenerator(conf_paths, path_output, opt_root, packages=opt_packages, dirindex=opt_dirindex,
+                               threads=opt_threads)
 
     title = "Custom profile written to %s" % profile.paths.path
     print title
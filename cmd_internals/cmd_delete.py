@@ -22,7 +22,7 @@ from os.path import *
 
 import sys
 import getopt
-from changes import Changes
+from changes import ChangesFile
 
 def usage(e=None):
     if e:
@@ -55,7 +55,7 @@ def main():
     delta = args[0]
     paths = args[1:]
 
-    changes = Changes.fromfile(delta, paths)
+    changes = ChangesFile(delta, paths)
     if simulate:
         verbose = True
 
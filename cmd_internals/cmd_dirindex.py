@@ -16,6 +16,13 @@ Options:
     -i --input=PATH     Read a list of paths from a file (- for stdin)
 
     -c --create         Create index
+    -b --binary         Create index in binary format (default: text)
+
+    -t --threads=N      Scan directories in parallel with N threads
+
+    --cache=PATH        Reuse unchanged directory listings from a previous run
+                        (cache is created/updated at PATH). Only saves reading
+                        directories, every entry is still stat'ed
 """
 import sys
 import getopt
@@ -33,13 +40,16 @@ def usage(e=None):
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'i:ch', 
-                                       ['create', 'input='])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'i:cbht:', 
+                                       ['create', 'binary', 'input=', 'threads=', 'cache='])
     except getopt.GetoptError, e:
         usage(e)
 
     opt_create = False
+    opt_binary = False
     opt_input = None
+    opt_threads = None
+    opt_cache = None
 
     for opt, val in opts:
         if opt in ('-h', '--help'):
@@ -48,9 +58,21 @@ def main():
         elif opt in ('-c', '--create'):
             opt_create = True
 
+        elif opt in ('-b', '--binary'):
+            opt_binary = True
+
         elif opt in ('-i', '--input'):
             opt_input = val
 
+        elif opt in ('-t', '--threads'):
+            try:
+                opt_threads = int(val)
+            except ValueError:
+                usage("illegal number of threads '%s'" % val)
+
+        elif opt == '--cache':
+            opt_cache = val
+
     if not args or (not opt_input and len(args) < 2):
         usage()
 
@@ -62,10 +84,10 @@ def main():
         paths = dirindex.read_paths(fh) + paths
 
     if opt_create:
-        dirindex.create(path_index, paths)
+        dirindex.create(path_index, paths, opt_threads, opt_binary)
         return
 
-    for change in changes.whatchanged(path_index, paths):
+    for change in changes.whatchanged(path_index, paths, opt_threads, opt_cache):
         print change
 
 if __name__=="__main__":
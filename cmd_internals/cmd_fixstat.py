@@ -26,7 +26,7 @@ import os
 import sys
 import getopt
 
-from changes import Changes
+from changes import ChangesFile
 
 def usage(e=None):
     if e:
@@ -70,7 +70,7 @@ def main():
     delta = args[0]
     paths = args[1:]
 
-    changes = Changes.fromfile(delta, paths)
+    changes = ChangesFile(delta, paths)
     if simulate:
         verbose = True
 
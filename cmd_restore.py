@@ -80,7 +80,18 @@ Options / System restore:
 
     --no-rollback                     Disable rollback
     --silent                          Disable feedback
+    --quiet                           Summarize file fixes with progress counters
+                                      instead of printing each fix
 
+    --threads=N                       Number of threads used to apply file fixes,
+                                      copy files, load MySQL tables and restore
+                                      PostgreSQL databases
+                                      default: 1
+
+    --resume                          Resume an interrupted MySQL restore from the
+                                      same backup extract, skipping the tables and
+                                      row segments it restored (implies --no-rollback
+                                      so the interrupted restore's rollback is kept)
 
     --noninteractive                  Disable interactive user prompts
     --force                           Disable sanity checking
@@ -299,6 +310,9 @@ def main():
     skip_packages = False
     no_rollback = False
     silent = False
+    quiet = False
+    threads = 1
+    resume = False
     interactive = True
 
     opt_debug = False
@@ -313,7 +327,8 @@ def main():
                                         'restore-cache-size=', 'restore-cache-dir=',
                                         'force',
                                         'time=',
-                                        'silent',
+                                        'silent', 'quiet',
+                                        'threads=', 'resume',
                                         'noninteractive',
                                         'debug',
                                         'skip-files', 'skip-database', 'skip-packages',
@@ -364,6 +379,18 @@ def main():
             no_rollback = True
         elif opt == '--silent':
             silent = True
+        elif opt == '--quiet':
+            quiet = True
+        elif opt == '--threads':
+            try:
+                threads = int(val)
+                if threads < 1:
+                    raise ValueError
+            except ValueError:
+                fatal("%s=%s is not a positive number" % (opt, val))
+        elif opt == '--resume':
+            resume = True
+            no_rollback = True
         elif opt == '--force':
             opt_force = True
         elif opt == '--logfile':
@@ -501,7 +528,8 @@ def main():
         if not silent:
             print fmt_title("Restoring system from backup extract at " + backup_extract_path)
 
-        restore = Restore(backup_extract_path, limits=opt_limits, rollback=not no_rollback, simulate=opt_simulate)
+        restore = Restore(backup_extract_path, limits=opt_limits, rollback=not no_rollback, simulate=opt_simulate,
+                          threads=threads, quiet=quiet, resume=resume)
 
         if restore.conf:
             os.environ['TKLBAM_RESTORE_PROFILE_ID'] = restore.conf.profile_id
@@ -119,13 +119,48 @@ class Conf(AttrDict):
             except ValueError:
                 raise self.Error("s3-parallel-uploads not a number (%s)" % val)
 
+        if name == 'database_threads':
+            try:
+                val = int(val)
+            except ValueError:
+                raise self.Error("database-threads not a number (%s)" % val)
+
+            if val < 1:
+                raise self.Error("database-threads must be at least 1 (%d)" % val)
+
+        if name == 'mysql_segment_size':
+            try:
+                val = int(val)
+            except ValueError:
+                raise self.Error("mysql-segment-size not a number (%s)" % val)
+
+            if val < 0:
+                raise self.Error("mysql-segment-size can't be negative (%d)" % val)
+
+        if name == 'pgsql_jobs':
+            try:
+                val = int(val)
+            except ValueError:
+                raise self.Error("pgsql-jobs not a number (%s)" % val)
+
+            if val < 1:
+                raise self.Error("pgsql-jobs must be at least 1 (%d)" % val)
+
+        if name == 'mysql_compress':
+            if val == 'none':
+                val = None
+
+            if val not in (None, 'gzip', 'zstd'):
+                raise self.Error("bad mysql-compress value (%s)" % val)
+
         if name == 'restore_cache_size':
             if not re.match(r'^\d+(%|mb?|gb?)?$', val, re.IGNORECASE):
                 raise self.Error("bad restore-cache value (%s)" % val)
 
         backup_skip_options = [ 'backup_skip_' + opt
                                 for opt in ('files', 'database', 'packages') ]
-        if name in backup_skip_options:
+        if name in backup_skip_options + [ 'dirindex_cache', 'mysql_tsv', 'mysql_incremental', 'mysql_lock', 'pgsql_incremental',
+                                           'pipelined' ]:
             if val not in (True, False):
                 if re.match(r'^true|1|yes$', val, re.IGNORECASE):
                     val = True
@@ -134,7 +169,7 @@ class Conf(AttrDict):
                 else:
                     raise self.Error("bad bool value '%s'" % val)
 
-            if val:
+            if val and name in backup_skip_options:
                 os.environ['TKLBAM_' + name.upper()] = 'yes'
 
         AttrDict.__setitem__(self, name, val)
@@ -156,6 +191,17 @@ class Conf(AttrDict):
         self.s3_parallel_uploads = duplicity.Uploader.S3_PARALLEL_UPLOADS
         self.full_backup = duplicity.Uploader.FULL_IF_OLDER_THAN
 
+        self.dirindex_cache = False
+        self.database_threads = 1
+        self.mysql_tsv = False
+        self.mysql_incremental = False
+        self.mysql_compress = None
+        self.mysql_lock = True
+        self.mysql_segment_size = 0
+        self.pgsql_jobs = 1
+        self.pgsql_incremental = False
+        self.pipelined = False
+
         self.restore_cache_size = duplicity.Downloader.CACHE_SIZE
         self.restore_cache_dir = duplicity.Downloader.CACHE_DIR
 
@@ -177,9 +223,13 @@ class Conf(AttrDict):
                 raise self._error("illegal line '%s'" % (line))
 
             try:
-                if opt in ('full-backup', 'volsize', 's3-parallel-uploads',
+                if opt in ('full-backup', 'volsize', 's3-parallel-uploads', 'database-threads',
                            'restore-cache-size', 'restore-cache-dir',
-                           'backup-skip-files', 'backup-skip-packages', 'backup-skip-database', 'force-profile'):
+                           'backup-skip-files', 'backup-skip-packages', 'backup-skip-database', 'force-profile',
+                           'dirindex-cache',
+                           'mysql-tsv', 'mysql-incremental', 'mysql-compress', 'mysql-lock',
+                           'mysql-segment-size', 'pgsql-jobs', 'pgsql-incremental',
+                           'pipelined'):
 
                     attrname = opt.replace('-', '_')
                     setattr(self, attrname, val)
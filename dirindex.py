@@ -11,15 +11,25 @@
 import re
 import os
 import stat
+import heapq
+import mmap
+import struct
+import time
+import marshal
 from os.path import *
 
 from pathmap import PathMap
+from threadpool import ThreadPool
 
 class Error(Exception):
     pass
 
 class DirIndex(dict):
-    class Record:
+    class Record(object):
+        # indexes can have millions of records: __slots__ saves us a
+        # per-instance __dict__, which is most of the memory footprint
+        __slots__ = ('path', 'mod', 'uid', 'gid', 'size', 'mtime', 'symlink')
+
         def __init__(self, path, mod, uid, gid, size, mtime,
                      symlink=None):
             self.path = path
@@ -32,8 +42,10 @@ class DirIndex(dict):
 
         @classmethod
         def frompath(cls, path):
-            st = os.lstat(path)
+            return cls.fromstat(path, os.lstat(path))
 
+        @classmethod
+        def fromstat(cls, path, st):
             symlink = os.readlink(path) \
                       if stat.S_ISLNK(st.st_mode) else None
 
@@ -72,16 +84,22 @@ class DirIndex(dict):
                     (`self.path`, oct(self.mod), self.uid, self.gid, self.size, self.mtime)
 
     @classmethod
-    def create(cls, path_index, paths):
+    def create(cls, path_index, paths, threads=None, binary=False):
         """create index from paths"""
         di = cls()
-        di.walk(*paths)
-        di.save(path_index)
+        di.walk(*paths, threads=threads)
+        di.save(path_index, binary)
 
         return di
 
     def __init__(self, fromfile=None):
         if fromfile:
+            if is_binary(fromfile):
+                for rec in MappedDirIndex(fromfile).itervalues():
+                    self[rec.path] = rec
+
+                return
+
             for line in file(fromfile).readlines():
                 if not line.strip():
                     continue
@@ -93,40 +111,74 @@ class DirIndex(dict):
         """add a single path to the DirIndex"""
         self[path] = DirIndex.Record.frompath(path)
 
-    def walk(self, *paths):
-        """walk paths and add files to index"""
-        pathmap = PathMap(paths)
-
-        def _walk(dir):
-            dentries = []
+    def walk(self, *paths, **kws):
+        """walk paths and add files to index
 
-            for dentry in os.listdir(dir):
-                path = join(dir, dentry)
-                if path in pathmap.excludes:
-                    continue
+        Keyword arguments:
 
-                dentries.append(dentry)
+            threads     scan directories in parallel with a pool of threads
+                        (default: walk directories one after another)
 
-                if not islink(path) and isdir(path):
-                    for val in _walk(path):
-                        yield val
+            cache       ListingCache to reuse unchanged directory listings from
+        """
+        threads = kws.pop('threads', None)
+        cache = kws.pop('cache', None)
+        if kws:
+            raise TypeError("unexpected keyword arguments: " + ", ".join(kws))
 
-            yield dir, dentries
+        pathmap = PathMap(paths)
 
+        roots = []
         for path in pathmap.includes:
-            if not lexists(path):
+            rec = _lstat_record(path)
+            if rec is None:
                 continue
 
-            self.add_path(path)
+            self[path] = rec
 
-            if islink(path) or not isdir(path):
-                continue
+            if stat.S_ISDIR(rec.mod):
+                roots.append(path)
+
+        if threads and threads > 1:
+            records = self._walk_parallel(threads, roots, pathmap.excludes, cache)
+        else:
+            records = self._walk(roots, pathmap.excludes, cache)
+
+        for rec in records:
+            self[rec.path] = rec
+
+    @staticmethod
+    def _walk(roots, excludes, cache=None):
+        dirs = list(roots)
+        while dirs:
+            for rec in _scandir(dirs.pop(), excludes, cache):
+                if stat.S_ISDIR(rec.mod):
+                    dirs.append(rec.path)
+
+                yield rec
+
+    @staticmethod
+    def _walk_parallel(threads, roots, excludes, cache=None):
+        pool = ThreadPool(threads)
+
+        # list.extend is atomic so workers can share this without a lock
+        records = []
 
-            for dpath, dentries in _walk(path):
-                for dentry in dentries:
-                    path = join(dpath, dentry)
+        def _scan(dir):
+            dir_records = _scandir(dir, excludes, cache)
+            for rec in dir_records:
+                if stat.S_ISDIR(rec.mod):
+                    pool.submit(_scan, rec.path)
 
-                    self.add_path(path)
+            records.extend(dir_records)
+
+        try:
+            for path in roots:
+                pool.submit(_scan, path)
+        finally:
+            pool.join()
+
+        return records
 
     def prune(self, *paths):
         """prune index down to paths that are included AND not excluded"""
@@ -136,10 +188,15 @@ class DirIndex(dict):
             if not path in pathmap:
                 del self[path]
 
-    def save(self, tofile):
+    def save(self, tofile, binary=False):
         fh = file(tofile, "w")
         paths = self.keys()
         paths.sort()
+
+        if binary:
+            MappedDirIndex.write(fh, [ self[path] for path in paths ])
+            return
+
         for path in paths:
             print >> fh, self[path].fmt()
 
@@ -151,46 +208,430 @@ class DirIndex(dict):
         paths_stat = []
 
         for path in (b - a):
-            mod = other[path].mod
-
-            # ignore Unix sockets
-            if stat.S_ISSOCK(mod):
-                continue
-
-            if stat.S_ISDIR(mod):
+            kind = _diff_new(other[path])
+            if kind == 'stat':
                 paths_stat.append(path)
-            else:
+            elif kind == 'new':
                 files_new.append(path)
 
         paths_in_both = b & a
         files_edited = []
-        def attrs_equal(attrs, a, b):
-            for attr in attrs:
-                if getattr(a, attr) != getattr(b, attr):
-                    return False
 
+        for path in paths_in_both:
+            kind = _diff_both(self[path], other[path])
+            if kind == 'edited':
+                files_edited.append(path)
+            elif kind == 'stat':
+                paths_stat.append(path)
+
+        return files_new, files_edited, paths_stat
+
+create = DirIndex.create
+
+class MappedDirIndex(object):
+    """Read-only view of a binary dirindex file.
+
+    The file is mmap'ed and records are only unpacked when accessed, so
+    opening a large index is instant and lookups are a binary search over
+    the record table.
+
+    Format (little endian):
+
+        header          magic, version, record size, number of records
+        record table    fixed-width records sorted by path
+        string pool     paths and symlink targets referenced by offset
+
+    """
+    MAGIC = "TKLBAMDI"
+    VERSION = 1
+
+    HEADER = struct.Struct("<8sIIQ")
+
+    # path offset, path len, mod, uid, gid, size, mtime, symlink offset, symlink len
+    RECORD = struct.Struct("<QIIIIQqQI4x")
+
+    class Error(Error):
+        pass
+
+    def __init__(self, path):
+        fh = file(path)
+        self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+
+        magic, version, record_size, count = self.HEADER.unpack_from(self.mmap, 0)
+        if magic != self.MAGIC:
+            raise self.Error("not a binary dirindex: " + path)
+
+        if version != self.VERSION or record_size != self.RECORD.size:
+            raise self.Error("unsupported binary dirindex version (%d): %s" % (version, path))
+
+        self.count = count
+        self.pool_offset = self.HEADER.size + count * self.RECORD.size
+
+    @classmethod
+    def write(cls, fh, records):
+        """write records (must be sorted by path) to fh in binary format"""
+        pool = []
+        pool_len = [0]
+
+        def add_string(s):
+            offset = pool_len[0]
+            pool.append(s)
+            pool_len[0] += len(s)
+            return offset
+
+        fh.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.RECORD.size, len(records)))
+        for rec in records:
+            path_offset = add_string(rec.path)
+            if rec.symlink:
+                symlink_offset = add_string(rec.symlink)
+                symlink_len = len(rec.symlink)
+            else:
+                symlink_offset = symlink_len = 0
+
+            fh.write(cls.RECORD.pack(path_offset, len(rec.path),
+                                     rec.mod, rec.uid, rec.gid,
+                                     rec.size, int(rec.mtime),
+                                     symlink_offset, symlink_len))
+
+        for s in pool:
+            fh.write(s)
+
+    def _string(self, offset, length):
+        offset += self.pool_offset
+        return self.mmap[offset:offset + length]
+
+    def _path(self, i):
+        path_offset, path_len = struct.unpack_from("<QI", self.mmap,
+                                                   self.HEADER.size + i * self.RECORD.size)
+        return self._string(path_offset, path_len)
+
+    def _record(self, i):
+        path_offset, path_len, mod, uid, gid, size, mtime, symlink_offset, symlink_len = \
+                self.RECORD.unpack_from(self.mmap, self.HEADER.size + i * self.RECORD.size)
+
+        symlink = self._string(symlink_offset, symlink_len) if symlink_len else None
+        return DirIndex.Record(self._string(path_offset, path_len),
+                               mod, uid, gid, size, mtime, symlink)
+
+    def _bisect(self, path):
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self.count and self._path(lo) == path:
+            return lo
+
+        return None
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, path):
+        return self._bisect(path) is not None
+
+    def __getitem__(self, path):
+        i = self._bisect(path)
+        if i is None:
+            raise KeyError(path)
+
+        return self._record(i)
+
+    def get(self, path, default=None):
+        i = self._bisect(path)
+        if i is None:
+            return default
+
+        return self._record(i)
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self._path(i)
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        for i in xrange(self.count):
+            yield self._record(i)
+
+def is_binary(path):
+    """Returns True if path is a binary dirindex"""
+    magic = MappedDirIndex.MAGIC
+    return file(path).read(len(magic)) == magic
+
+def _lstat_record(path):
+    """Return a DirIndex.Record for path or None if it doesn't exist"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+
+    return DirIndex.Record.fromstat(path, st)
+
+def _scandir(dir, excludes=[], cache=None):
+    """Scan a single directory and return a list of DirIndex.Records.
+
+    We lstat each entry exactly once and derive everything else (is it a
+    directory? a symlink?) from the resulting st_mode instead of calling
+    islink() / isdir() and then stat'ing the same path again.
+    """
+    dentries = cache.listdir(dir) if cache else os.listdir(dir)
+
+    records = []
+    for dentry in dentries:
+        path = join(dir, dentry)
+        if path in excludes:
+            continue
+
+        st = os.lstat(path)
+        if cache and stat.S_ISDIR(st.st_mode):
+            cache.note(path, st)
+
+        records.append(DirIndex.Record.fromstat(path, st))
+
+    return records
+
+class ListingCache:
+    """Directory listings saved between runs (e.g., consecutive backups).
+
+    A directory's ctime changes whenever entries are added, removed or
+    renamed in it, so if its device, inode and ctime haven't changed we
+    can reuse the cached listing instead of reading the directory again.
+    We can't rely on the mtime because it can be set from userspace
+    (e.g., by tar, rsync -a or touch -r).
+
+    We still lstat every entry. Editing a file or changing its ownership
+    doesn't touch the ctime of the directory it's in, so reusing cached
+    records for unchanged directories would miss changes. All we save is
+    the readdir, and a walk still takes time in proportion to the size of
+    the tree rather than to how much of it changed.
+
+    Directories modified less than RACY_SECONDS before the previous scan
+    started are always re-read, otherwise a change racing the previous
+    scan could be missed. A missing, unreadable or incompatible cache file
+    means a full rescan.
+
+    Note that the listings of all scanned directories are held in memory.
+    """
+    VERSION = 2
+    RACY_SECONDS = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.timestamp = time.time()
+
+        self.old = {}
+        self.old_timestamp = None
+
+        try:
+            version, timestamp, listings = marshal.load(file(path))
+            if version == self.VERSION:
+                self.old = listings
+                self.old_timestamp = timestamp
+        except Exception:
+            pass
+
+        self.new = {}
+        self.stats = {}
+
+    def note(self, path, st):
+        """remember stat of a directory we're going to list later"""
+        self.stats[path] = st
+
+    def listdir(self, dir):
+        st = self.stats.pop(dir, None) or os.lstat(dir)
+        key = (st.st_dev, st.st_ino, st.st_ctime)
+
+        cached = self.old.pop(dir, None)
+        if cached and cached[0] == key and \
+           st.st_ctime < self.old_timestamp - self.RACY_SECONDS:
+            dentries = cached[1]
+        else:
+            dentries = os.listdir(dir)
+
+        self.new[dir] = (key, dentries)
+        return dentries
+
+    def save(self):
+        path_tmp = self.path + ".tmp"
+
+        fh = file(path_tmp, "w")
+        marshal.dump((self.VERSION, self.timestamp, self.new), fh)
+        fh.close()
+
+        os.rename(path_tmp, self.path)
+
+def _diff_new(rec):
+    """Classify a record that only exists in the new index.
+    Returns 'new', 'stat' or None (ignore)"""
+
+    # ignore Unix sockets
+    if stat.S_ISSOCK(rec.mod):
+        return None
+
+    if stat.S_ISDIR(rec.mod):
+        return 'stat'
+
+    return 'new'
+
+def _diff_both(a, b):
+    """Compare old record <a> with new record <b> of the same path.
+    Returns 'edited', 'stat' or None (unchanged)"""
+
+    def attrs_equal(attrs, a, b):
+        for attr in attrs:
+            if getattr(a, attr) != getattr(b, attr):
+                return False
+
+        return True
+
+    def symlink_equal(a, b):
+        if a.symlink and (a.symlink == b.symlink):
             return True
 
-        def symlink_equal(a, b):
-            if a.symlink and (a.symlink == b.symlink):
-                return True
+        return False
+
+    if not attrs_equal(('size', 'mtime'), a, b):
+        mod = b.mod
+        if not (stat.S_ISDIR(mod) or stat.S_ISSOCK(mod)) \
+           and not symlink_equal(a, b):
+            return 'edited'
+
+    if not attrs_equal(('mod', 'uid', 'gid'), a, b):
+        return 'stat'
+
+    return None
+
+def _walk_sorted(dir, excludes, cache=None):
+    # a directory sorts as its own path, its contents sort as path + '/'.
+    # Sorting siblings on these keys yields exactly the order in which
+    # DirIndex.save() writes paths (e.g., /a/b, /a/b-c, /a/b/c, /a/b0)
+    entries = []
+    for rec in _scandir(dir, excludes, cache):
+        entries.append((rec.path, False, rec))
+        if stat.S_ISDIR(rec.mod):
+            entries.append((rec.path + '/', True, rec))
+
+    entries.sort()
+    for key, descend, rec in entries:
+        if descend:
+            for subrec in _walk_sorted(rec.path, excludes, cache):
+                yield subrec
+        else:
+            yield rec
+
+def walk_sorted(*paths, **kws):
+    """Walk paths and yield records sorted by path, like DirIndex.walk()
+    but in constant memory (only one directory listing per level)
+
+    Keyword arguments:
+
+        cache       ListingCache to reuse unchanged directory listings from
+    """
+    cache = kws.pop('cache', None)
+    if kws:
+        raise TypeError("unexpected keyword arguments: " + ", ".join(kws))
+
+    pathmap = PathMap(paths)
+    excludes = pathmap.excludes
+
+    def walk_root(path):
+        rec = _lstat_record(path)
+        if rec is None:
+            return
+
+        yield path, rec
+
+        if stat.S_ISDIR(rec.mod):
+            for subrec in _walk_sorted(path, excludes, cache):
+                yield subrec.path, subrec
+
+    # includes may overlap (e.g., /etc -/etc/foo /etc/foo/bar)
+    last = None
+    for path, rec in heapq.merge(*[ walk_root(path) for path in pathmap.includes ]):
+        if path == last:
+            continue
+
+        last = path
+        yield rec
+
+def _is_sorted(path):
+    last = None
+    for line in file(path):
+        if not line.strip():
+            continue
 
+        rec_path = line.split('\t', 1)[0]
+        if last is not None and rec_path <= last:
             return False
 
-        for path in paths_in_both:
-            if not attrs_equal(('size', 'mtime'), self[path], other[path]):
-                mod = other[path].mod
-                if not (stat.S_ISDIR(mod) or stat.S_ISSOCK(mod)) \
-                   and not symlink_equal(self[path], other[path]):
-                    files_edited.append(path)
-                    continue
+        last = rec_path
 
-            if not attrs_equal(('mod', 'uid', 'gid'), self[path], other[path]):
-                paths_stat.append(path)
+    return True
 
-        return files_new, files_edited, paths_stat
+def iterfile(path):
+    """Yield records from a saved dirindex sorted by path.
 
-create = DirIndex.create
+    DirIndex.save() writes paths sorted so we can usually stream the file.
+    Otherwise (e.g., a hand made profile) we fall back to loading it."""
+
+    if is_binary(path):
+        for rec in MappedDirIndex(path).itervalues():
+            yield rec
+
+        return
+
+    if not _is_sorted(path):
+        di = DirIndex(path)
+        for rec_path in sorted(di):
+            yield di[rec_path]
+
+        return
+
+    for line in file(path):
+        if not line.strip():
+            continue
+
+        yield DirIndex.Record.fromline(line)
+
+def iterdiff(old, new):
+    """Merge two streams of records sorted by path (e.g., iterfile() and
+    walk_sorted()) and yield (kind, record) tuples for changed paths.
+
+    kind is one of 'new', 'edited', 'stat' or 'deleted'. Records are
+    yielded from the new stream except for 'deleted'.
+    """
+    old = iter(old)
+    new = iter(new)
+
+    a = next(old, None)
+    b = next(new, None)
+
+    while a is not None or b is not None:
+        if b is None or (a is not None and a.path < b.path):
+            yield 'deleted', a
+            a = next(old, None)
+
+        elif a is None or b.path < a.path:
+            kind = _diff_new(b)
+            if kind:
+                yield kind, b
+
+            b = next(new, None)
+
+        else:
+            kind = _diff_both(a, b)
+            if kind:
+                yield kind, b
+
+            a = next(old, None)
+            b = next(new, None)
 
 def read_paths(fh):
     paths = []
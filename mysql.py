@@ -14,27 +14,40 @@ import os
 from os.path import *
 
 import signal
+import socket
+import select
 import time
+import ctypes
+import ctypes.util
 
 import re
 from paths import Paths as _Paths
 
 import shutil
-from string import Template
+import tempfile
+import threading
 from subprocess import Popen, PIPE
 
 from dblimits import DBLimits
 import executil
 
 import stat
+import errno
 from command import Command
+from threadpool import ThreadPool
 
 class Error(Exception):
     pass
 
 PATH_DEBIAN_CNF = "/etc/mysql/debian.cnf"
+PATH_SOCKET = "/var/run/mysqld/mysqld.sock"
+
+# not dumped by mysqldump --all-databases
+IGNORE_DATABASES = ('information_schema', 'performance_schema', 'sys')
+
+def _mysql_opts(opts=None, defaults_file=None, **conf):
+    opts = list(opts) if opts else []
 
-def _mysql_opts(opts=[], defaults_file=None, **conf):
     def isreadable(path):
         try:
             file(path)
@@ -54,12 +67,27 @@ def _mysql_opts(opts=[], defaults_file=None, **conf):
 
     return " ".join([ "--" + opt for opt in opts ])
 
-def mysqldump(**conf):
-    opts = [ "all-databases", "skip-extended-insert", "single-transaction",
-             "compact", "quick" ]
+def mysqldump(no_data=False, databases=None, ignore_tables=[], **conf):
+    """Dump <databases> (default: all databases) except the (database, table)
+    tuples in <ignore_tables>"""
+    opts = [ "skip-extended-insert", "single-transaction", "compact", "quick" ]
+    if databases is None:
+        opts.insert(0, "all-databases")
+    else:
+        opts.insert(0, "databases")
+
+    if no_data:
+        opts.append("no-data")
+
+    args = [ "--ignore-table=%s.%s" % (database, table) for database, table in ignore_tables ]
+    if databases:
+        args += databases
 
     command = "mysqldump " + _mysql_opts(opts, **conf)
-    popen = Popen(command, shell=True, stderr=PIPE, stdout=PIPE)
+    if args:
+        command += " " + " ".join([ executil.mkarg(arg) for arg in args ])
+
+    popen = Popen(command, shell=True, close_fds=True, stderr=PIPE, stdout=PIPE)
 
     firstline = popen.stdout.readline()
     if not firstline:
@@ -79,6 +107,324 @@ def mysql(**conf):
 
     return os.popen(command, "w")
 
+class Timings:
+    """Number of calls and time spent in them, by name"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.elapsed = {}
+
+    def add(self, name, started):
+        """add call to <name> that started at <started> (a time.time() value)"""
+        elapsed = time.time() - started
+
+        self.lock.acquire()
+        try:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.elapsed[name] = self.elapsed.get(name, 0) + elapsed
+        finally:
+            self.lock.release()
+
+    def __str__(self):
+        return ", ".join([ "%s %dx %.3fs" % (name, self.calls[name], self.elapsed[name])
+                           for name in sorted(self.calls) ])
+
+timings = Timings()
+
+def _socket_path():
+    """Returns path of the server's unix socket"""
+    try:
+        for line in file(PATH_DEBIAN_CNF).readlines():
+            m = re.match(r'\s*socket\s*=\s*(\S+)', line)
+            if m:
+                return m.group(1)
+    except IOError:
+        pass
+
+    return PATH_SOCKET
+
+def ping():
+    """Returns True if the server accepts connections on its unix socket.
+    Like mysqladmin ping, this doesn't need access to the server."""
+    started = time.time()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    try:
+        try:
+            sock.connect(_socket_path())
+
+            # the server greets connections with a handshake (or error) packet
+            return sock.recv(5) != ''
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+        timings.add('ping', started)
+
+# linux/inotify.h
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_CLOEXEC = 02000000
+
+class _CreateWatch:
+    """inotify watch for entries created in a directory, so we can block
+    until a file appears rather than poll for it"""
+    def __init__(self, dir):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        if libc.inotify_add_watch(self.fd, dir, IN_CREATE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err), dir)
+
+    def wait(self, timeout):
+        """block until an entry is created or <timeout> seconds pass"""
+        if select.select([ self.fd ], [], [], timeout)[0]:
+            os.read(self.fd, 4096)
+
+    def close(self):
+        os.close(self.fd)
+
+class MysqlConnection:
+    """Persistent mysql client session.
+
+    Each query is written to a mysql --batch process followed by a marker
+    query, and results are read up to the marker, so one client process
+    and server connection serve any number of queries. mysql exits on
+    errors, in which case the next query starts a new session.
+    """
+    MARKER = "--tklbam-end-of-results--"
+
+    def __init__(self, **conf):
+        self.conf = conf
+        self.popen = None
+        self.lock = threading.Lock()
+
+    def _read_results(self):
+        rows = []
+        while True:
+            line = self.popen.stdout.readline()
+            if not line:
+                returncode = self.popen.wait()
+                stderr = self.popen.stderr.read()
+                self.popen = None
+
+                raise Error("mysql error (%d): %s" % (returncode, stderr))
+
+            line = line.rstrip("\n")
+            if line == self.MARKER:
+                return rows
+
+            rows.append(line.split('\t'))
+
+    def _query(self, sql):
+        sql = sql.strip()
+        if not sql.endswith(';'):
+            sql += ';'
+
+        try:
+            print >> self.popen.stdin, sql
+            print >> self.popen.stdin, "SELECT '%s';" % self.MARKER
+            self.popen.stdin.flush()
+        except IOError:
+            # mysql exited, _read_results() raises the error
+            pass
+
+        return self._read_results()
+
+    def _connect(self):
+        started = time.time()
+
+        command = "mysql " + _mysql_opts(["batch", "skip-column-names", "unbuffered"], **self.conf)
+        self.popen = Popen(command, shell=True, close_fds=True,
+                           stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        self._query("")
+
+        timings.add('connect', started)
+
+    def query(self, sql):
+        """Execute <sql>. Returns list of result rows (lists of column values)"""
+        self.lock.acquire()
+        try:
+            if not self.popen:
+                self._connect()
+
+            started = time.time()
+            try:
+                return self._query(sql)
+            finally:
+                timings.add('query', started)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.popen:
+                self.popen.stdin.close()
+                self.popen.wait()
+                self.popen = None
+        finally:
+            self.lock.release()
+
+_connections = {}
+
+def connection(**conf):
+    """Returns MysqlConnection shared by everyone connecting with <conf>"""
+    key = tuple(sorted(conf.items()))
+    if key not in _connections:
+        _connections[key] = MysqlConnection(**conf)
+
+    return _connections[key]
+
+def close_connections():
+    for connection in _connections.values():
+        connection.close()
+
+def query(sql, **conf):
+    """Execute <sql> in a shared mysql session (see connection). Returns
+    list of result rows (lists of column values)"""
+    return connection(**conf).query(sql)
+
+def dump_limits(limits, **conf):
+    """Translate DBLimits <limits> to what we need to dump, so that excluded
+    databases and table rows never leave the server.
+
+    Returns (databases, excluded) where <databases> is the list of
+    databases to dump (None for all) and <excluded> is a list of
+    (database, table) tuples of tables in those databases whose rows are
+    excluded.
+    """
+    limits = DBLimits(limits)
+    if not limits.d:
+        return None, []
+
+    databases = [ database for database, in query("SHOW DATABASES", **conf)
+                  if database not in IGNORE_DATABASES and database in limits ]
+
+    excluded = [ (database, table)
+                 for database, table in query("SELECT table_schema, table_name "
+                                              "FROM information_schema.tables "
+                                              "WHERE table_type = 'BASE TABLE'", **conf)
+                 if database in databases and (database, table) not in limits ]
+
+    return databases, excluded
+
+def has_local_infile(**conf):
+    """Returns True if the server allows LOAD DATA LOCAL INFILE"""
+    try:
+        return query("SELECT @@local_infile", **conf) == [ [ '1' ] ]
+    except Error:
+        return False
+
+class GlobalReadLock:
+    """Hold FLUSH TABLES WITH READ LOCK in a mysql session of its own until
+    released, so that other sessions can start consistent snapshots of the
+    same point in time.
+
+    mysql exits on errors and the lock goes with its session, so check()
+    and release() raise an Error if the lock was lost.
+    """
+
+    def __init__(self, **conf):
+        self.connection = MysqlConnection(**conf)
+        self.connection.query("FLUSH TABLES WITH READ LOCK")
+
+    @staticmethod
+    def _check(connection):
+        # a new session wouldn't hold the lock
+        if not connection.popen:
+            raise Error("lost global read lock")
+
+        try:
+            connection.query("SELECT 1")
+        except Error, e:
+            raise Error("lost global read lock: " + str(e))
+
+    def check(self):
+        """raise an Error if we lost the lock"""
+        self._check(self.connection)
+
+    def release(self):
+        if not self.connection:
+            return
+
+        connection = self.connection
+        self.connection = None
+        try:
+            self._check(connection)
+            connection.query("UNLOCK TABLES")
+        finally:
+            connection.close()
+
+class MysqlDumpTables:
+    """mysqldump process dumping the rows of <tables>, a dict of
+    {database: [table, ...]}, in a single session.
+
+    Rows of more than one database are dumped with --databases, so any
+    other tables in those databases have to be in <ignore_tables> (list of
+    (database, table) tuples).
+
+    The process is started immediately. Once started() returns the dump
+    has its snapshot (see GlobalReadLock).
+    """
+    OPTS = [ "no-create-info", "no-create-db", "skip-triggers", "skip-extended-insert",
+             "single-transaction", "compact", "quick" ]
+
+    def __init__(self, tables, ignore_tables=[], **conf):
+        self.tables = tables
+
+        databases = sorted(tables)
+        if len(databases) == 1:
+            opts = self.OPTS
+            args = databases + sorted(tables[databases[0]])
+        else:
+            opts = [ "databases" ] + self.OPTS
+            args = [ "--ignore-table=%s.%s" % (database, table)
+                     for database, table in ignore_tables
+                     if database in tables ] + databases
+
+        command = "mysqldump " + _mysql_opts(opts, **conf) + " " + \
+                  " ".join([ executil.mkarg(arg) for arg in args ])
+        # stderr goes to a file as nobody reads it while we dump, so a
+        # pipe could fill up and block mysqldump
+        self.stderr = tempfile.TemporaryFile()
+        self.popen = Popen(command, shell=True, close_fds=True, stderr=self.stderr, stdout=PIPE)
+        self.firstline = None
+        self.started_time = time.time()
+
+    def started(self):
+        """block until mysqldump has output something (or exited)"""
+        if self.firstline is None:
+            self.firstline = self.popen.stdout.readline()
+
+    def read(self, size=-1):
+        self.started()
+
+        if self.firstline:
+            buf = self.firstline
+            self.firstline = ""
+            return buf
+
+        return self.popen.stdout.read(size)
+
+    def close(self):
+        returncode = self.popen.wait()
+        timings.add('mysqldump', self.started_time)
+
+        self.stderr.seek(0)
+        stderr = self.stderr.read()
+        self.stderr.close()
+
+        if returncode != 0:
+            raise Error("mysqldump error (%d): %s" % (returncode, stderr))
+
 class MyFS:
     class Database:
         class Paths(_Paths):
@@ -86,31 +432,230 @@ class MyFS:
 
     class Table:
         class Paths(_Paths):
-            files = [ 'init', 'triggers', 'rows' ]
+            files = [ 'init', 'triggers', 'rows', 'rows.tsv', 'checksum',
+                      'segments', 'restored' ]
 
     class View:
         class Paths(_Paths):
             files = [ 'pre', 'post' ]
 
+BUFSIZE = 1024 * 1024
+
+_RE_NAME = re.compile(r'`(.*?)`')
+_RE_VIEW_POST = re.compile(r'^/\*!50001 CREATE.* VIEW `(.*?)`', re.DOTALL)
+_RE_TRIGGER = re.compile(r'^/\*!50003 CREATE.* TRIGGER ', re.DOTALL)
+_RE_ROW = re.compile(r'.*?VALUES \((.*)\);')
+
 def _match_name(sql):
-    m = re.search(r'`(.*?)`', sql)
+    m = _RE_NAME.search(sql)
     if m:
         return m.group(1)
-    
+
+# Table rows are stored either as SQL (rows) or tab separated (rows.tsv).
+#
+# SQL rows are the VALUES of a mysqldump INSERT statement.
+#
+# TSV rows are what LOAD DATA INFILE expects by default: fields separated
+# by tabs, NULL as \N and special characters escaped with a backslash.
+# mysqldump escapes string values the same way, except for tabs, so we can
+# convert between the two without unescaping. Values LOAD DATA can't take
+# as is (e.g., b'0101' bit values) aren't supported in TSV rows.
+
+_FIELD = r"'[^'\\]*(?:\\.[^'\\]*)*'|NULL|-?[0-9][0-9.eE+-]*"
+_RE_FIELD = re.compile(_FIELD, re.DOTALL)
+_RE_FIELDS = re.compile(r"(?:%s)(?:,(?:%s))*\Z" % (_FIELD, _FIELD), re.DOTALL)
+
+def _sql2tsv(row):
+    """Convert SQL row values to a TSV row. Returns None if unsupported"""
+    if not _RE_FIELDS.match(row):
+        return None
+
+    fields = []
+    for field in _RE_FIELD.findall(row):
+        if field == 'NULL':
+            field = '\\N'
+        elif field[0] == "'":
+            field = field[1:-1].replace('\t', '\\t')
+
+        fields.append(field)
+
+    return '\t'.join(fields)
+
+def _quote(s):
+    """quote string for use as an SQL string literal"""
+    return s.replace('\\', '\\\\').replace("'", "\\'")
+
+def _tsv2sql(row):
+    """Convert TSV row to SQL row values (all values quoted)"""
+    return ",".join([ "NULL" if field == '\\N' else "'" + field + "'"
+                      for field in row.split('\t') ])
+
+# Rows files may be compressed by piping them through a gzip or zstd
+# process. Readers recognize compressed rows files by their magic number.
+COMPRESSORS = {
+    'gzip': ('\x1f\x8b\x08', "gzip -c", "gzip -dc"),
+    'zstd': ('\x28\xb5\x2f\xfd', "zstd -q -c", "zstd -q -dc")
+}
+
+def _compression(path):
+    """Returns name of compressor used for file at <path> (or None)"""
+    magic = file(path).read(4)
+    for name in COMPRESSORS:
+        if magic.startswith(COMPRESSORS[name][0]):
+            return name
+
+def _has_command(command):
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        if os.access(join(path, command), os.X_OK):
+            return True
+    return False
+
+class _CompressedFile:
+    """Write-only file compressed by a <compress> process. The process is
+    started on the first write, so that nothing written is an empty file,
+    like it would be without compression."""
+    def __init__(self, path, compress):
+        self.fh = file(path, "w")
+        self.command = COMPRESSORS[compress][1]
+        self.popen = None
+
+    def write(self, s):
+        if not self.popen:
+            self.popen = Popen(self.command, shell=True, bufsize=BUFSIZE, close_fds=True,
+                               stdin=PIPE, stdout=self.fh, stderr=PIPE)
+        self.popen.stdin.write(s)
+
+    def close(self):
+        if self.popen:
+            self.popen.stdin.close()
+            returncode = self.popen.wait()
+            if returncode != 0:
+                raise Error("%s error (%d): %s" % (self.command, returncode, self.popen.stderr.read()))
+            self.popen = None
+
+        self.fh.close()
+
+def _decompress_lines(path, command):
+    popen = Popen(command, shell=True, bufsize=BUFSIZE, close_fds=True,
+                  stdin=file(path), stdout=PIPE, stderr=PIPE)
+    for line in popen.stdout:
+        yield line
+
+    returncode = popen.wait()
+    if returncode != 0:
+        raise Error("%s error (%d): %s" % (command, returncode, popen.stderr.read()))
+
+def _readlines(path):
+    """Returns iterator over lines of file at <path>, decompressing it if needed"""
+    compress = _compression(path)
+    if not compress:
+        return file(path, "r", BUFSIZE)
+
+    return _decompress_lines(path, COMPRESSORS[compress][2])
+
+def _read_segments(manifest):
+    """Returns list of (fname, rows) tuples in segments <manifest>"""
+    segments = []
+    for line in file(manifest).readlines():
+        fname, rows = line.split()
+        segments.append((fname, int(rows)))
+    return segments
+
+class _SegmentedFile:
+    """Write-only file split at line boundaries into segments of about
+    <size> bytes: <path>.000000, <path>.000001, etc. On close, segments
+    are listed in <manifest> along with the number of lines in each. If
+    everything fits in one segment it's renamed to <path> instead.
+
+    <open> is called to open segments for writing.
+    """
+    def __init__(self, path, size, manifest, open):
+        self.path = path
+        self.size = size
+        self.manifest = manifest
+        self.open = open
+
+        self.segments = []
+        self.fh = None
+        self._next()
+
+    def _next(self):
+        if self.fh:
+            self.fh.close()
+            self.segments.append((basename(self.fh_path), self.lines))
+
+        self.fh_path = "%s.%06d" % (self.path, len(self.segments))
+        self.fh = self.open(self.fh_path)
+        self.written = 0
+        self.lines = 0
+
+    def write(self, s):
+        if self.written >= self.size:
+            self._next()
+
+        self.fh.write(s)
+        self.written += len(s)
+        self.lines += s.count("\n")
+
+    def close(self):
+        if not self.fh:
+            return
+
+        self.fh.close()
+        if self.segments:
+            self.segments.append((basename(self.fh_path), self.lines))
+
+            fh = file(self.manifest, "w")
+            for fname, lines in self.segments:
+                print >> fh, fname, lines
+            fh.close()
+        else:
+            os.rename(self.fh_path, self.path)
+
+        self.fh = None
+
 def _parse_statements(fh, delimiter=';'):
-    statement = ""
-    for line in fh.xreadlines():
-        if line.startswith("--"):
-            continue
-        if not line.strip():
-            continue
-        if line.startswith("DELIMITER"):
-            delimiter = line.split()[1]
-            continue
-        statement += line
-        if statement.strip().endswith(delimiter):
-            yield statement.strip()
-            statement = ""
+    """Read SQL from fh in large chunks and yield stripped statements.
+
+    Most mysqldump statements (e.g., INSERTs) are on a single line, so
+    we only accumulate lines for multi-line statements."""
+
+    parts = []
+    tail = ""
+    while True:
+        chunk = fh.read(BUFSIZE)
+        if chunk:
+            lines = chunk.split("\n")
+            lines[0] = tail + lines[0]
+            tail = lines.pop()
+        elif tail:
+            lines = [ tail ]
+            tail = ""
+        else:
+            break
+
+        for line in lines:
+            if line.startswith("--"):
+                continue
+
+            stripped = line.strip()
+            if not stripped:
+                continue
+
+            if line.startswith("DELIMITER"):
+                delimiter = line.split()[1]
+                continue
+
+            if not stripped.endswith(delimiter):
+                parts.append(line)
+                continue
+
+            if parts:
+                parts.append(line)
+                yield "\n".join(parts).strip()
+                parts = []
+            else:
+                yield stripped
 
 class MyFS_Writer(MyFS):
     class Database(MyFS.Database):
@@ -121,12 +666,13 @@ class MyFS_Writer(MyFS):
                     os.makedirs(paths)
                 self.paths = paths
 
-        def __init__(self, outdir, name, sql):
+        def __init__(self, outdir, name, sql=None):
             self.paths = self.Paths(join(outdir, name))
             if not exists(self.paths):
                 os.mkdir(self.paths)
 
-            print >> file(self.paths.init, "w"), sql
+            if sql is not None:
+                print >> file(self.paths.init, "w"), sql
             self.name = name
 
         def add_view_pre(self, name, sql):
@@ -138,28 +684,107 @@ class MyFS_Writer(MyFS):
             print >> file(view.paths.post, "w"), sql
 
     class Table(MyFS.Table):
-        def __init__(self, database, name, sql):
+        def __init__(self, database, name, sql=None, tsv=False, compress=None, segment_size=None):
             self.paths = self.Paths(join(database.paths.tables, name))
             if not exists(self.paths):
                 os.makedirs(self.paths)
 
-            print >> file(self.paths.init, "w"), sql
-            if exists(self.paths.triggers):
-                os.remove(self.paths.triggers)
-
-            self.rows_fh = file(self.paths.rows, "w")
+            # sql is None when we're only adding rows to a table we've
+            # already written the schema for
+            if sql is not None:
+                print >> file(self.paths.init, "w"), sql
+                if exists(self.paths.triggers):
+                    os.remove(self.paths.triggers)
+
+            # rows may be hardlinked to the MyFSCache, so we never write
+            # into existing rows files
+            self._remove_segments()
+            for path in (self.paths.rows, self.paths.rows_tsv, self.paths.checksum,
+                         self.paths.restored):
+                if exists(path):
+                    os.remove(path)
+
+            self.tsv = tsv
+            self.compress = compress
+            self.segment_size = segment_size
+            self.rows_fh = self._open_rows(self.paths.rows_tsv if tsv else self.paths.rows)
             self.name = name
             self.database = database
 
+            self.insert_prefix = "INSERT INTO `%s` VALUES (" % name
+
+        def _remove_segments(self):
+            if not exists(self.paths.segments):
+                return
+
+            for fname, rows in _read_segments(self.paths.segments):
+                path = join(self.paths, fname)
+                if exists(path):
+                    os.remove(path)
+
+            os.remove(self.paths.segments)
+
+        def _open_segment(self, path):
+            if self.compress:
+                return _CompressedFile(path, self.compress)
+            return file(path, "w", BUFSIZE)
+
+        def _open_rows(self, path):
+            if self.segment_size:
+                return _SegmentedFile(path, self.segment_size, self.paths.segments,
+                                      self._open_segment)
+            return self._open_segment(path)
+
+        def _tsv2sql(self):
+            """fallback from TSV to SQL rows"""
+            self.rows_fh.close()
+
+            if exists(self.paths.segments):
+                paths = [ join(self.paths, fname)
+                          for fname, rows in _read_segments(self.paths.segments) ]
+                os.remove(self.paths.segments)
+            else:
+                paths = [ self.paths.rows_tsv ]
+
+            self.rows_fh = self._open_rows(self.paths.rows)
+            for path in paths:
+                for line in _readlines(path):
+                    self.rows_fh.write(_tsv2sql(line.rstrip("\n")) + "\n")
+
+                os.remove(path)
+
+            self.tsv = False
+
         def add_row(self, sql):
-            print >> self.rows_fh, re.sub(r'.*?VALUES \((.*)\);', '\\1', sql)
+            if sql.startswith(self.insert_prefix) and sql.endswith(");"):
+                row = sql[len(self.insert_prefix):-2]
+            else:
+                row = _RE_ROW.sub('\\1', sql)
+
+            if self.tsv:
+                tsv_row = _sql2tsv(row)
+                if tsv_row is None:
+                    self._tsv2sql()
+                else:
+                    row = tsv_row
+
+            self.rows_fh.write(row + "\n")
 
         def add_trigger(self, sql):
             print >> file(self.paths.triggers, "a"), sql + "\n"
 
-    def __init__(self, outdir, limits=[]):
+    def __init__(self, outdir, limits=[], tsv=False, compress=None, segment_size=None):
+        """If <compress> (see COMPRESSORS) rows are compressed. If
+        <segment_size>, rows are split into segments of about that many
+        (uncompressed) bytes"""
+        if compress and not _has_command(COMPRESSORS[compress][1].split()[0]):
+            raise Error("can't compress rows with %s: command not found" % compress)
+
         self.limits = DBLimits(limits)
         self.outdir = outdir
+        self.tsv = tsv
+        self.compress = compress
+        self.segment_size = segment_size
 
     def fromfile(self, fh, callback=None):
         databases = {}
@@ -167,6 +792,15 @@ class MyFS_Writer(MyFS):
         table = None
 
         for statement in _parse_statements(fh):
+            # by far the most common statement, so we check for it first
+            if statement.startswith("INSERT INTO"):
+                if database and table and not table_ignore_inserts:
+                    if not statement.startswith(table.insert_prefix):
+                        assert _match_name(statement) == table.name
+                    table.add_row(statement)
+
+                continue
+
             if statement.startswith("CREATE DATABASE"):
                 database_name = _match_name(statement)
 
@@ -186,24 +820,29 @@ class MyFS_Writer(MyFS):
                 if not database:
                     continue
 
+                if table:
+                    table.rows_fh.close()
                 table = None
 
             if not database:
                 continue
 
-            m = re.match(r'^/\*!50001 CREATE.* VIEW `(.*?)`', statement, re.DOTALL)
+            m = _RE_VIEW_POST.match(statement)
             if m:
                 view_name = m.group(1)
                 database.add_view_post(view_name, statement)
 
-            elif re.match(r'^/\*!50001 CREATE TABLE', statement):
+            elif statement.startswith("/*!50001 CREATE TABLE"):
                 view_name = _match_name(statement)
                 database.add_view_pre(view_name, statement)
 
             elif statement.startswith("CREATE TABLE"):
                 table_name = _match_name(statement)
 
-                table = self.Table(database, table_name, statement)
+                if table:
+                    table.rows_fh.close()
+                table = self.Table(database, table_name, statement,
+                                   self.tsv, self.compress, self.segment_size)
                 if (database.name, table_name) in self.limits:
                     if callback:
                         callback(table)
@@ -215,41 +854,369 @@ class MyFS_Writer(MyFS):
             if not table:
                 continue
 
-            if re.match(r'^/\*!50003 CREATE.* TRIGGER ', statement, re.DOTALL):
+            if _RE_TRIGGER.match(statement):
                 table.add_trigger(statement)
 
-            elif not table_ignore_inserts and statement.startswith("INSERT INTO"):
-                assert _match_name(statement) == table.name
-                table.add_row(statement)
+        if table:
+            table.rows_fh.close()
+
+    def rowsfromfile(self, fh, tables):
+        """Add rows from a data-only dump (see MysqlDumpTables) of <tables>
+        ({database: [table, ...]}) whose schema we've already written.
+        Rows of any other tables are skipped"""
+        databases = sorted(tables)
+        database = self.Database(self.outdir, databases[0]) if len(databases) == 1 else None
+        table = None
+        skip = False
+
+        for statement in _parse_statements(fh):
+            # dumps of more than one database switch between them
+            if statement.startswith("USE "):
+                if table:
+                    table.rows_fh.close()
+                table = None
+
+                database_name = _match_name(statement)
+                database = self.Database(self.outdir, database_name) \
+                           if database_name in tables else None
+                continue
+
+            if not database or not statement.startswith("INSERT INTO"):
+                continue
+
+            if not table or not statement.startswith(table.insert_prefix):
+                table_name = _match_name(statement)
+                if not table or table.name != table_name:
+                    if table:
+                        table.rows_fh.close()
+                    table = None
+
+                    skip = table_name not in tables[database.name]
+                    if not skip:
+                        table = self.Table(database, table_name, tsv=self.tsv,
+                                           compress=self.compress, segment_size=self.segment_size)
+
+            if skip:
+                continue
+
+            table.add_row(statement)
+
+        if table:
+            table.rows_fh.close()
+
+def mysql2fs(fh, outdir, limits=[], callback=None, tsv=False, compress=None, segment_size=None):
+    MyFS_Writer(outdir, limits, tsv, compress, segment_size).fromfile(fh, callback)
+
+def checksum_tables(tables, **conf):
+    """Returns dict of CHECKSUM TABLE results for list of (database, table)
+    tuples. Tables that don't exist are left out."""
+    def quote(name):
+        return "`%s`" % name.replace('`', '``')
+
+    checksums = {}
+    for i in range(0, len(tables), 100):
+        chunk = tables[i:i + 100]
+        sql = "CHECKSUM TABLE " + ", ".join([ quote(database) + "." + quote(table)
+                                              for database, table in chunk ])
+
+        # results are in the order of the tables we asked for
+        for (database, table), row in zip(chunk, query(sql, **conf)):
+            if row[-1] != 'NULL':
+                checksums[(database, table)] = row[-1]
+
+    return checksums
+
+def update_markers(racy_seconds=2, **conf):
+    """Returns dict of cheap change markers for (database, table) tuples of
+    base tables, made of their create and update times.
 
-def mysql2fs(fh, outdir, limits=[], callback=None):
-    MyFS_Writer(outdir, limits).fromfile(fh, callback)
+    Tables whose update time is unknown (e.g., InnoDB forgets it on restart)
+    or less than <racy_seconds> old get no marker, as a write in the same
+    second wouldn't change it. Under a GlobalReadLock nothing can commit, so
+    the markers match the snapshots started under it.
+    """
+    # MySQL 8 caches table statistics, update times included. Setting a
+    # variable the server doesn't have is an error, which ends the session
+    if query("SHOW VARIABLES LIKE 'information_schema_stats_expiry'", **conf):
+        query("SET SESSION information_schema_stats_expiry = 0", **conf)
+
+    markers = {}
+    for database, table, create_time, update_time, racy in \
+            query("SELECT table_schema, table_name, create_time, update_time, "
+                  "update_time >= NOW() - INTERVAL %d SECOND "
+                  "FROM information_schema.tables "
+                  "WHERE table_type = 'BASE TABLE'" % racy_seconds, **conf):
+
+        if update_time != 'NULL' and racy == '0':
+            markers[(database, table)] = "updated %s %s" % (create_time, update_time)
+
+    return markers
+
+def _rows_fnames(paths):
+    """Returns names of files with the rows of MyFS table <paths>"""
+    if exists(paths.segments):
+        return [ 'segments' ] + [ fname for fname, rows in _read_segments(paths.segments) ]
+
+    return [ basename(path) for path in (paths.rows, paths.rows_tsv)
+             if exists(path) ]
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy(src, dst)
+
+class MyFSCache:
+    """Rows of tables from a previous backup, with their change markers
+    (see update_markers) or checksums.
+
+    Rows files are hardlinked between the cache and MyFS, which is why
+    MyFS_Writer.Table never writes into existing rows files.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def rows(self, database, table, marker, tsv=False):
+        """Returns paths of cached table if its marker matches and it
+        has rows we can use"""
+        paths = MyFS.Table.Paths(join(self.path, database, table))
+        try:
+            if file(paths.checksum).read().strip() != marker:
+                return None
+        except IOError:
+            return None
+
+        fnames = _rows_fnames(paths)
+        if not fnames:
+            return None
+
+        if not tsv and [ fname for fname in fnames if fname.startswith('rows.tsv') ]:
+            return None
+
+        return paths
+
+    @staticmethod
+    def link(cached, table_paths):
+        """Link <cached> table rows into a MyFS table"""
+        for fname in _rows_fnames(table_paths):
+            os.remove(join(table_paths, fname))
+
+        for fname in _rows_fnames(cached):
+            _link(join(cached, fname), join(table_paths, fname))
+
+    def update(self, myfs):
+        """Replace cache with the tables in <myfs> that have markers"""
+        tmp = self.path + ".tmp"
+        if exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        for database in os.listdir(myfs):
+            tables = MyFS.Database.Paths(join(myfs, database)).tables
+            if not isdir(tables):
+                continue
+
+            for table in os.listdir(tables):
+                paths = MyFS.Table.Paths(join(tables, table))
+                if not exists(paths.checksum):
+                    continue
+
+                cached = join(tmp, database, table)
+                os.makedirs(cached)
+                for fname in [ 'checksum' ] + _rows_fnames(paths):
+                    _link(join(paths, fname), join(cached, fname))
+
+        if exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp, self.path)
+
+def mysql2fs_parallel(outdir, threads, limits=[], callback=None, tsv=False, consistent=True,
+                      cache=None, compress=None, segment_size=None):
+    """Dump MySQL to MyFS <outdir> with <threads> mysqldump processes.
+
+    The schema is dumped first, then the rows of tables are dumped
+    concurrently, with tables balanced between threads by size. If
+    <consistent> all row dumps start from a snapshot of the same point in
+    time, taken under a global read lock.
+
+    If <cache> is the path of a MyFSCache, rows of tables that haven't
+    changed since they were cached are linked rather than dumped. Whether
+    a table changed is told by its update marker (see update_markers), or
+    if it has none by its checksum. Both are taken under the global read
+    lock, so they match the snapshot the changed tables are dumped from.
+    Note that the lock is held while tables without a marker are
+    checksummed.
+    """
+    writer = MyFS_Writer(outdir, limits, tsv, compress, segment_size)
+    if cache:
+        cache = MyFSCache(cache)
+
+    def table_paths(database, table):
+        database_paths = MyFS.Database.Paths(join(outdir, database))
+        return MyFS.Table.Paths(join(database_paths.tables, table))
+
+    def get_sizes():
+        sizes = {}
+        for database, table, size in query("SELECT table_schema, table_name, data_length "
+                                           "FROM information_schema.tables "
+                                           "WHERE table_type = 'BASE TABLE'"):
+
+            if database in IGNORE_DATABASES or \
+               (database, table) not in writer.limits:
+                continue
+
+            sizes[(database, table)] = int(size) if size != 'NULL' else 0
+
+        return sizes
+
+    def checksum_markers(tables):
+        return dict([ (key, "checksum " + checksum)
+                      for key, checksum in checksum_tables(tables).items() ])
+
+    databases, excluded = dump_limits(limits)
+
+    lock = GlobalReadLock() if consistent else None
+    try:
+        if databases != []:
+            writer.fromfile(mysqldump(no_data=True, databases=databases), callback)
+        sizes = dict([ (key, size) for key, size in get_sizes().items()
+                       if exists(table_paths(*key).init) ])
+
+        markers = {}
+        checksums = {}
+        if cache:
+            markers = update_markers()
+            checksums = checksum_markers([ key for key in sorted(sizes)
+                                           if key not in markers ])
+
+        cached = {}
+        for key in sizes:
+            marker = markers.get(key) or checksums.get(key)
+            if marker:
+                rows = cache.rows(key[0], key[1], marker, tsv)
+                if rows:
+                    cached[key] = rows
+
+        # largest tables first, each to the thread with the least data
+        loads = [ 0 ] * threads
+        tables = [ {} for i in range(threads) ]
+        for database, table in sorted(sizes, key=lambda k: sizes[k], reverse=True):
+            if (database, table) in cached:
+                continue
+
+            i = loads.index(min(loads))
+            loads[i] += sizes[(database, table)]
+            tables[i].setdefault(database, []).append(table)
+
+        # one mysqldump per thread, whatever the number of databases, so
+        # we don't open more connections (and snapshots) than threads
+        base_tables = [ tuple(row) for row in query("SELECT table_schema, table_name "
+                                                    "FROM information_schema.tables "
+                                                    "WHERE table_type = 'BASE TABLE'") ]
+        def ignore_tables(tables):
+            return [ (database, table) for database, table in base_tables
+                     if database in tables and table not in tables[database] ]
+
+        if lock:
+            lock.check()
+
+        dumps = [ MysqlDumpTables(thread_tables, ignore_tables(thread_tables))
+                  for thread_tables in tables if thread_tables ]
+
+        if lock:
+            for dump in dumps:
+                dump.started()
+    finally:
+        # raises if the lock was lost before all dumps had their snapshot
+        if lock:
+            lock.release()
+
+    def run(dump):
+        writer.rowsfromfile(dump, dump.tables)
+        dump.close()
+
+    if dumps:
+        pool = ThreadPool(len(dumps))
+        try:
+            for dump in dumps:
+                pool.submit(run, dump)
+        finally:
+            pool.join()
+
+    if not cache:
+        return
+
+    for key, rows in cached.items():
+        MyFSCache.link(rows, table_paths(*key))
+
+    for key in sizes:
+        marker = markers.get(key) or checksums.get(key)
+        if marker:
+            print >> file(table_paths(*key).checksum, "w"), marker
+
+    cache.update(outdir)
 
 def chunkify(elements, delim, maxlen):
-    chunk = ""
+    delim_len = len(delim)
+
+    chunk = []
+    chunk_len = 0
     for element in elements:
-        if len(chunk) + len(delim) + len(element) > maxlen:
+        element_len = len(element)
+        if chunk_len + delim_len + element_len > maxlen:
             if chunk:
-                yield chunk
+                yield delim.join(chunk)
 
-            if len(element) > maxlen:
+            if element_len > maxlen:
                 ## locally correct logic:
                 #raise Error("element='%s' longer than maxlen=%d" % (element, maxlen))
 
                 ## globally correct logic (the lesser evil):
                 yield element
-                chunk = ""
+                chunk = []
+                chunk_len = 0
                 continue
 
-            chunk = element
+            chunk = [ element ]
+            chunk_len = element_len
         else:
             if not chunk:
-                chunk = element
+                chunk = [ element ]
+                chunk_len = element_len
             else:
-                chunk += delim + element
+                chunk.append(element)
+                chunk_len += delim_len + element_len
 
     if chunk:
-        yield chunk
+        yield delim.join(chunk)
+
+def _compile(tpl):
+    """Compile string.Template <tpl> to an equivalent % format string,
+    which is much cheaper to fill in"""
+    return re.sub(r'\$(\w+)', r'%(\1)s', tpl.replace('%', '%%'))
+
+class _BufferedWriter:
+    """Joins small writes to <fh> into writes of about <size> bytes"""
+    def __init__(self, fh, size=BUFSIZE):
+        self.fh = fh
+        self.size = size
+
+        self.buf = []
+        self.buffered = 0
+
+    def write(self, s):
+        self.buf.append(s)
+        self.buffered += len(s)
+        if self.buffered >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.fh.write("".join(self.buf))
+            self.buf = []
+            self.buffered = 0
 
 class MyFS_Reader(MyFS):
     MAX_EXTENDED_INSERT = 1000000 - 1024
@@ -278,6 +1245,9 @@ $sql
 /*!50001 SET character_set_results     = @saved_cs_results */;
 /*!50001 SET collation_connection      = @saved_col_connection */;
 """
+            FMT_PRE = _compile(TPL_PRE)
+            FMT_POST = _compile(TPL_POST)
+
             class Error(Exception):
                 pass
 
@@ -292,14 +1262,14 @@ $sql
                 if not exists(self.paths.pre):
                     return
                 sql = file(self.paths.pre).read().strip()
-                return Template(self.TPL_PRE).substitute(name=self.name, sql=sql)
+                return self.FMT_PRE % { 'name': self.name, 'sql': sql }
             pre = property(pre)
 
             def post(self):
                 if not exists(self.paths.post):
                     return
                 sql = file(self.paths.post).read().strip()
-                return Template(self.TPL_POST).substitute(name=self.name, sql=sql)
+                return self.FMT_POST % { 'name': self.name, 'sql': sql }
             post = property(post)
             
         def __init__(self, myfs, fname):
@@ -334,7 +1304,9 @@ $sql
                 yield view
         views = property(views)
 
-        def tofile(self, fh, callback=None):
+        def tofile(self, fh, callback=None, rows=True, skip=()):
+            """if not <rows>, only create tables (see MyFS_Reader.tofile_schema).
+            Tables whose (database, table) names are in <skip> are left out."""
             if callback:
                 callback(self)
 
@@ -344,9 +1316,16 @@ $sql
             print >> fh, "USE `%s`;" % self.name
 
             for table in self.tables:
+                if (self.name, table.name) in skip:
+                    continue
+
                 if callback:
                     callback(table)
-                table.tofile(fh)
+
+                if rows:
+                    table.tofile(fh)
+                else:
+                    table.tofile_create(fh)
 
             for view in self.views:
                 if view.pre:
@@ -370,6 +1349,9 @@ LOCK TABLES `$name` WRITE;
 UNLOCK TABLES;
 """
 
+        TPL_LOAD_DATA = """\
+LOAD DATA LOCAL INFILE '$path' INTO TABLE `$name` CHARACTER SET utf8;"""
+
         TPL_TRIGGERS_PRE = """\
 /*!50003 SET @saved_cs_client      = @@character_set_client */ ;
 /*!50003 SET @saved_cs_results     = @@character_set_results */ ;
@@ -389,6 +1371,11 @@ DELIMITER ;
 /*!50003 SET collation_connection  = @saved_col_connection */ ;
 """
 
+        FMT_CREATE = _compile(TPL_CREATE)
+        FMT_INSERT_PRE = _compile(TPL_INSERT_PRE).strip()
+        FMT_INSERT_POST = _compile(TPL_INSERT_POST)
+        FMT_LOAD_DATA = _compile(TPL_LOAD_DATA)
+
         def __init__(self, database, fname):
             self.paths = self.Paths(join(database.paths.tables, fname))
             self.sql_init = file(self.paths.init).read()
@@ -398,17 +1385,46 @@ DELIMITER ;
         def __repr__(self):
             return "Table(%s)" % `self.paths.path`
 
+        def segments(self):
+            """paths of rows files (more than one if rows are split into segments)"""
+            return [ join(self.paths, fname) for fname in _rows_fnames(self.paths)
+                     if fname != 'segments' ]
+        segments = property(segments)
+
+        @staticmethod
+        def _rows(segments):
+            for path in segments:
+                if basename(path).startswith('rows.tsv'):
+                    for line in _readlines(path):
+                        yield _tsv2sql(line.rstrip("\n"))
+                else:
+                    for line in _readlines(path):
+                        yield line.strip()
+
         def rows(self):
-            for line in file(self.paths.rows).xreadlines():
-                yield line.strip()
+            return self._rows(self.segments)
+
+        def is_tsv(self):
+            segments = self.segments
+            return bool(segments) and basename(segments[0]).startswith('rows.tsv')
+
+        def is_segmented(self):
+            return exists(self.paths.segments)
+
+        def size(self):
+            return sum([ os.lstat(path).st_size for path in self.segments ])
 
         def has_rows(self):
-            if exists(self.paths.rows) and os.lstat(self.paths.rows).st_size != 0:
-                return True
-            return False
+            return self.size() != 0
 
         rows = property(rows)
 
+        def restored(self):
+            """names of rows files already restored (see fs2mysql_parallel)"""
+            if not exists(self.paths.restored):
+                return set()
+            return set(file(self.paths.restored).read().split())
+
         def triggers(self):
             if not exists(self.paths.triggers):
                 return []
@@ -416,49 +1432,82 @@ DELIMITER ;
             return list(_parse_statements(file(self.paths.triggers), ';;'))
         triggers = property(triggers)
 
-        def tofile(self, fh):
+        def is_log_table(self):
+            return self.database.name == "mysql" and self.name in ('general_log', 'slow_log')
+        is_log_table = property(is_log_table)
+
+        def tofile_create(self, fh):
+            if not self.is_log_table:
+                print >> fh, "DROP TABLE IF EXISTS `%s`;" % self.name
+
+            fh.write(self.FMT_CREATE % { 'init': self.sql_init } + "\n")
+
+        def _tofile_segment(self, fh, path):
             skip_extended_insert = self.database.myfs.skip_extended_insert
             max_extended_insert = self.database.myfs.max_extended_insert
 
-            is_log_table = (self.database.name == "mysql" and self.name in ('general_log', 'slow_log'))
+            insert_prefix = "INSERT INTO `%s` VALUES " % self.name
+            # LOAD DATA can't read compressed files
+            if basename(path).startswith('rows.tsv') and self.database.myfs.load_data and \
+               not _compression(path):
+                fh.write(self.FMT_LOAD_DATA % { 'name': self.name,
+                                                'path': _quote(abspath(path)) } + "\n")
 
-            if not is_log_table:
-                print >> fh, "DROP TABLE IF EXISTS `%s`;" % self.name
+            elif skip_extended_insert:
+                for row in self._rows([ path ]):
+                    fh.write(insert_prefix + "(" + row + ");\n")
 
-            print >> fh, Template(self.TPL_CREATE).substitute(init=self.sql_init)
+            else:
+                if basename(path).startswith('rows.tsv'):
+                    rows = ( "(" + row + ")" for row in self._rows([ path ]) )
+                else:
+                    rows = ( "(" + line.strip() + ")" for line in _readlines(path) )
+                row_chunks = chunkify(rows, ",\n", max_extended_insert - len(insert_prefix + ";"))
 
-            if self.has_rows():
-                if not is_log_table:
-                    print >> fh, Template(self.TPL_INSERT_PRE).substitute(name=self.name).strip()
+                index = None
+                for index, chunk in enumerate(row_chunks):
 
-                insert_prefix = "INSERT INTO `%s` VALUES " % self.name
-                if skip_extended_insert:
-                    for  row in self.rows:
-                        print >> fh, insert_prefix + "(%s);" % row
-                        
-                else:
-                    rows = ( "(%s)" % row for row in self.rows )
-                    row_chunks = chunkify(rows, ",\n", max_extended_insert - len(insert_prefix + ";"))
+                    fh.write(insert_prefix + "\n" + chunk + ";\n")
 
-                    index = None
-                    for index, chunk in enumerate(row_chunks):
+                if index is not None:
+                    print >> fh, "\n-- CHUNKS: %d\n" % (index + 1)
 
-                        fh.write(insert_prefix + "\n")
-                        fh.write(chunk + ";")
-                        fh.write("\n")
+        def tofile_rows(self, fh, segment=None):
+            """If <segment> (a path in self.segments) only that segment's
+            rows are loaded, in a transaction and without locking the table,
+            so that segments of a table can be loaded concurrently"""
+            if segment:
+                print >> fh, "SET autocommit=0;"
+                self._tofile_segment(fh, segment)
+                print >> fh, "COMMIT;"
+                return
 
-                    if index is not None:
-                        print >> fh, "\n-- CHUNKS: %d\n" % (index + 1)
+            is_log_table = self.is_log_table
 
+            segments = self.segments
+            if sum([ os.lstat(path).st_size for path in segments ]) != 0:
                 if not is_log_table:
-                    print >> fh, Template(self.TPL_INSERT_POST).substitute(name=self.name)
+                    fh.write(self.FMT_INSERT_PRE % { 'name': self.name } + "\n")
 
-            if self.triggers:
+                for path in segments:
+                    self._tofile_segment(fh, path)
+
+                if not is_log_table:
+                    fh.write(self.FMT_INSERT_POST % { 'name': self.name } + "\n")
+
+        def tofile_triggers(self, fh):
+            triggers = self.triggers
+            if triggers:
                 print >> fh, self.TPL_TRIGGERS_PRE.strip()
-                for trigger in self.triggers:
+                for trigger in triggers:
                     print >> fh, trigger
                 print >> fh, self.TPL_TRIGGERS_POST
 
+        def tofile(self, fh):
+            self.tofile_create(fh)
+            self.tofile_rows(fh)
+            self.tofile_triggers(fh)
+
     PRE = """\
 /*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
 /*!40101 SET @OLD_CHARACTER_SET_RESULTS=@@CHARACTER_SET_RESULTS */;
@@ -486,11 +1535,16 @@ DELIMITER ;
     def __init__(self, path, limits=[], 
                  skip_extended_insert=False,
                  add_drop_database=False,
-                 max_extended_insert=None):
+                 max_extended_insert=None,
+                 load_data=False):
+        """If <load_data>, TSV rows are loaded with LOAD DATA LOCAL INFILE
+        (the mysql client needs --local-infile). Otherwise they're
+        converted back to INSERTs."""
         self.path = path
         self.limits = DBLimits(limits)
         self.skip_extended_insert = skip_extended_insert
         self.add_drop_database = add_drop_database
+        self.load_data = load_data
 
         if max_extended_insert is None:
             max_extended_insert = self.MAX_EXTENDED_INSERT
@@ -502,26 +1556,151 @@ DELIMITER ;
             if database.name in self.limits:
                 yield database
 
+    def _tofile_views(self, fh):
+        for database in self:
+            views = list(database.views)
+            if not views:
+                continue
+
+            print >> fh, "USE `%s`;" % database.name
+            for view in views:
+                print >> fh, "\n" + view.post
+
     def tofile(self, fh, callback=None):
         print >> fh, self.PRE
 
         for database in self:
             database.tofile(fh, callback)
 
+        self._tofile_views(fh)
+
+        print >> fh, self.POST
+
+    # tofile() split into parts, so that table rows can be loaded
+    # concurrently after the schema and before triggers and views
+
+    def tofile_schema(self, fh, callback=None, skip=()):
+        print >> fh, self.PRE
+
         for database in self:
-            views = list(database.views)
-            if not views:
-                continue
+            database.tofile(fh, callback, rows=False, skip=skip)
+
+        print >> fh, self.POST
+
+    def tofile_rows(self, fh, table, segment=None):
+        print >> fh, self.PRE
+        print >> fh, "USE `%s`;" % table.database.name
+        table.tofile_rows(fh, segment)
+        print >> fh, self.POST
+
+    def tofile_triggers_views(self, fh):
+        print >> fh, self.PRE
 
+        for database in self:
             print >> fh, "USE `%s`;" % database.name
-            for view in views:
-                print >> fh, "\n" + view.post
+            for table in database.tables:
+                table.tofile_triggers(fh)
+
+        self._tofile_views(fh)
 
         print >> fh, self.POST
 
-def fs2mysql(fh, myfs, limits=[], callback=None, skip_extended_insert=False, add_drop_database=False):
+def fs2mysql(fh, myfs, limits=[], callback=None, skip_extended_insert=False, add_drop_database=False,
+             load_data=False):
+
+    fh = _BufferedWriter(fh)
+    MyFS_Reader(myfs, limits, skip_extended_insert, add_drop_database,
+                load_data=load_data).tofile(fh, callback)
+    fh.flush()
+
+def fs2mysql_parallel(myfs, threads, limits=[], callback=None, skip_extended_insert=False, add_drop_database=False,
+                      load_data=False, resume=False):
+    """Restore MyFS to MySQL with concurrent mysql clients: schemas first,
+    then the rows of up to <threads> tables at a time (largest first),
+    and finally triggers and views.
+
+    Rows split into segments are loaded a segment at a time, so segments
+    of a table load concurrently. Loaded rows files are recorded in the
+    table's restored file. If <resume>, tables and segments restored by
+    an interrupted restore are skipped. This is only exact for
+    transactional (e.g., InnoDB) tables.
+    """
+    if resume:
+        add_drop_database = False
+
+    reader = MyFS_Reader(myfs, limits, skip_extended_insert, add_drop_database,
+                         load_data=load_data)
+
+    conf = { 'local_infile': '1' } if load_data else {}
+
+    def run(func, *args):
+        started = time.time()
+        fh = mysql(**conf)
+        try:
+            buffered = _BufferedWriter(fh)
+            func(buffered, *args)
+            buffered.flush()
+        finally:
+            status = fh.close()
+            timings.add('mysql', started)
+
+        if status:
+            raise Error("mysql error (%d)" % (status >> 8))
+
+    lock = threading.Lock()
+    def run_rows(table, path, segment):
+        run(reader.tofile_rows, table, segment)
+
+        lock.acquire()
+        try:
+            print >> file(table.paths.restored, "a"), basename(path)
+        finally:
+            lock.release()
+
+    skip = set()
+    units = []
+    tables = []
+    for database in reader:
+        for table in database.tables:
+            tables.append(table)
+            if resume:
+                restored = table.restored()
+            else:
+                restored = set()
+                if exists(table.paths.restored):
+                    os.remove(table.paths.restored)
+
+            # don't recreate tables we've restored rows to
+            if restored:
+                skip.add((database.name, table.name))
+
+            if not table.has_rows():
+                continue
+
+            if table.is_segmented():
+                for path in table.segments:
+                    if basename(path) not in restored:
+                        units.append((os.lstat(path).st_size, table, path, path))
 
-    MyFS_Reader(myfs, limits, skip_extended_insert, add_drop_database).tofile(fh, callback)
+            elif not restored:
+                units.append((table.size(), table, table.segments[0], None))
+
+    run(reader.tofile_schema, callback, skip)
+
+    units.sort(key=lambda unit: unit[0], reverse=True)
+
+    pool = ThreadPool(threads)
+    try:
+        for size, table, path, segment in units:
+            pool.submit(run_rows, table, path, segment)
+    finally:
+        pool.join()
+
+    run(reader.tofile_triggers_views)
+
+    for table in tables:
+        if exists(table.paths.restored):
+            os.remove(table.paths.restored)
 
 def cb_print(fh=None):
     if not fh:
@@ -534,15 +1713,21 @@ def cb_print(fh=None):
         elif isinstance(val, MyFS.Table):
             table = val
             print >> fh, "table: " + join(table.database.name, table.name)
+        elif isinstance(val, Timings):
+            print >> fh, "timings: " + str(val)
 
     return func
 
-def backup(myfs, etc, **kws):
+def backup(myfs, etc, threads=1, cache=None, consistent=True, **kws):
     """High level mysql backup command.
     Arguments:
 
-        <myfs>      Directory we create to save MySQL backup
-        <etc>       Directory where we save required MySQL etc configuration files (e.g., debian.cnf)
+        <myfs>          Directory we create to save MySQL backup
+        <etc>           Directory where we save required MySQL etc configuration files (e.g., debian.cnf)
+        <threads>       Number of concurrent mysqldump processes
+        <cache>         Path of MyFSCache for incremental backups (optional)
+        <consistent>    Take a global read lock so that more than one
+                        mysqldump process dump the same point in time
         """
 
     if not MysqlService.is_running():
@@ -553,12 +1738,37 @@ def backup(myfs, etc, **kws):
         mna = MysqlNoAuth()
 
     try:
-        mysqldump_fh = mysqldump()
+        if threads > 1 or cache:
+            if not exists(myfs):
+                os.mkdir(myfs)
 
-        if not exists(myfs):
-            os.mkdir(myfs)
+            mysql2fs_parallel(myfs, threads, cache=cache, consistent=consistent, **kws)
+        else:
+            if not exists(myfs):
+                os.mkdir(myfs)
 
-        mysql2fs(mysqldump_fh, myfs, **kws)
+            databases, excluded = dump_limits(kws.get('limits', []))
+
+            # --ignore-table leaves out the schema too, which we keep. It
+            # takes a second mysqldump, so if <consistent> we hold a global
+            # read lock until both dumps have their snapshot
+            lock = GlobalReadLock() if excluded and consistent else None
+            try:
+                mysqldump_fh = None
+                if databases != []:
+                    mysqldump_fh = mysqldump(databases=databases, ignore_tables=excluded)
+
+                if excluded:
+                    schema_kws = kws.copy()
+                    schema_kws['callback'] = None
+                    schema_databases = sorted(set([ database for database, table in excluded ]))
+                    mysql2fs(mysqldump(no_data=True, databases=schema_databases), myfs, **schema_kws)
+            finally:
+                if lock:
+                    lock.release()
+
+            if mysqldump_fh:
+                mysql2fs(mysqldump_fh, myfs, **kws)
 
         if not exists(etc):
             os.mkdir(etc)
@@ -566,10 +1776,17 @@ def backup(myfs, etc, **kws):
         shutil.copy(PATH_DEBIAN_CNF, etc)
 
     finally:
+        close_connections()
         if mna:
             mna.stop()
 
-def restore(myfs, etc, **kws):
+    callback = kws.get('callback')
+    if callback:
+        callback(timings)
+
+def restore(myfs, etc, threads=1, resume=False, **kws):
+    """High level mysql restore command. If <resume>, resume an interrupted
+    restore of <myfs> (see fs2mysql_parallel)"""
     if kws.pop('simulate', False):
         simulate = True
     else:
@@ -585,15 +1802,28 @@ def restore(myfs, etc, **kws):
         if not MysqlService.is_accessible():
             mna = MysqlNoAuth()
 
-        mysql_fh = mysql()
+        # TSV rows are converted back to INSERTs if we can't LOAD DATA
+        kws['load_data'] = has_local_infile()
+        if threads > 1 or resume:
+            mysql_fh = None
+        else:
+            mysql_fh = mysql(local_infile="1") if kws['load_data'] else mysql()
 
     try:
-        fs2mysql(mysql_fh, myfs, **kws)
-        mysql_fh.close()
+        if mysql_fh:
+            fs2mysql(mysql_fh, myfs, **kws)
+            mysql_fh.close()
+        else:
+            fs2mysql_parallel(myfs, threads, resume=resume, **kws)
     finally:
+        close_connections()
         if mna:
             mna.stop()
 
+    callback = kws.get('callback')
+    if callback:
+        callback(timings)
+
     if not simulate:
         shutil.copy(join(etc, basename(PATH_DEBIAN_CNF)), PATH_DEBIAN_CNF)
         MysqlService.reload()
@@ -602,6 +1832,12 @@ class MysqlService:
     INIT_SCRIPT = "/etc/init.d/mysql"
     PID_FILE = '/var/run/mysqld/mysqld.pid'
 
+    WAIT_INTERVAL = 0.1
+
+    # how often wait_running checks whether the server's command exited
+    # while it waits for the socket
+    WATCH_INTERVAL = 1
+
     class Error(Exception):
         pass
 
@@ -625,11 +1861,46 @@ class MysqlService:
 
     @classmethod
     def is_running(cls):
+        return ping()
+
+    @classmethod
+    def wait_running(cls, timeout, command=None):
+        """Wait up to <timeout> seconds for the server to accept connections
+        on its socket, or until <command> (running the server) exits.
+        Returns True if the server is running.
+
+        The server creates its socket once it's ready for connections, so
+        we block on that (with inotify) instead of polling."""
+        deadline = time.time() + timeout
+        socket_path = _socket_path()
+
         try:
-            executil.getoutput('mysqladmin -s ping')
-            return True
-        except executil.ExecError:
-            return False
+            watch = _CreateWatch(dirname(socket_path))
+        except (OSError, AttributeError):
+            watch = None
+
+        try:
+            while True:
+                if command and not command.running:
+                    return False
+
+                # connecting to a socket that doesn't exist yet fails anyway
+                if exists(socket_path) and ping():
+                    return True
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                if watch:
+                    watch.wait(min(remaining, cls.WATCH_INTERVAL))
+                else:
+                    time.sleep(min(remaining, cls.WAIT_INTERVAL))
+        finally:
+            if watch:
+                watch.close()
+
+        return cls.is_running()
 
     @classmethod
     def start(cls):
@@ -655,12 +1926,14 @@ class MysqlService:
         if not pid:
             return
 
+        close_connections()
+
         os.kill(pid, signal.SIGTERM)
         while True:
             if not cls._pid_exists(pid):
                 break
 
-            time.sleep(1)
+            time.sleep(cls.WAIT_INTERVAL)
 
     @classmethod
     def reload(cls):
@@ -673,10 +1946,10 @@ class MysqlService:
     @classmethod
     def is_accessible(cls):
         try:
-            executil.getoutput_popen("mysql --defaults-file=/etc/mysql/debian.cnf", "select 1")
+            query("SELECT 1")
             return True
 
-        except executil.ExecError:
+        except Error:
             return False
 
 class MysqlNoAuth:
@@ -700,16 +1973,7 @@ class MysqlNoAuth:
 
         command = Command(self.COMMAND)
 
-        def cb():
-            if MysqlService.is_running():
-                continue_waiting = False
-            else:
-                continue_waiting = True
-
-            return continue_waiting
-
-        command.wait(timeout=10, callback=cb)
-        if not command.running or not MysqlService.is_running():
+        if not MysqlService.wait_running(10, command) or not command.running:
             command.terminate()
             if was_running:
                 MysqlService.start()
@@ -725,6 +1989,7 @@ class MysqlNoAuth:
 
         self.stopped = True
         if self.command:
+            close_connections()
             os.kill(self.command.pid, signal.SIGINT)
             self.command.wait()
             self.command = None
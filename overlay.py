@@ -0,0 +1,255 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Copy a list of paths from one directory tree onto another, in process.
+
+This replaces a tar --create | tar --extract pipeline and follows the
+same semantics:
+
+- paths are relative to src and dst (leading slashes are stripped)
+- directories are copied recursively
+- missing parent directories are created
+- existing destination files and symlinks are replaced, not written into
+- ownership (if we're root), modes and mtimes are preserved
+- hardlinks between copied files are preserved
+- symlinks, fifos and device nodes are recreated, sockets are skipped
+- paths missing from src are skipped
+- directory attributes are applied last so that copying their contents
+  doesn't change their mtime
+- errors are reported on stderr and the path skipped, the rest is still
+  copied. Then an Error listing the failed paths is raised (like tar's
+  exit status)
+
+Like tar without --xattrs, extended attributes are not copied.
+
+Regular files are copied by a pool of threads. Where the filesystem
+supports it (e.g., btrfs, xfs) the data is reflinked rather than copied.
+
+Usage example::
+
+    overlay.apply("/", "/tmp/overlay", ["etc/hostname", "var/www"], threads=4)
+"""
+import sys
+import os
+from os.path import *
+
+import stat
+import errno
+import fcntl
+import shutil
+import ctypes
+import ctypes.util
+
+from threadpool import ThreadPool
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+BUFSIZE = 1024 * 1024
+
+class Error(Exception):
+    pass
+
+# python has no lutimes, so we call utimensat(2) ourselves
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+
+class _timespec(ctypes.Structure):
+    _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+def _lutime(path, atime, mtime):
+    """set times of <path> without following it if it's a symlink"""
+    times = (_timespec * 2)(*[ _timespec(int(t), int(t % 1 * 1000000000))
+                               for t in (atime, mtime) ])
+    if _libc.utimensat(AT_FDCWD, path, times, AT_SYMLINK_NOFOLLOW) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+def _copy_data(src, dst):
+    fh_src = file(src, "rb")
+    try:
+        fh_dst = file(dst, "wb")
+        try:
+            try:
+                fcntl.ioctl(fh_dst.fileno(), FICLONE, fh_src.fileno())
+                return
+            except IOError:
+                # not supported or across filesystems: copy the data
+                pass
+
+            shutil.copyfileobj(fh_src, fh_dst, BUFSIZE)
+        finally:
+            fh_dst.close()
+    finally:
+        fh_src.close()
+
+def _unlink(path):
+    """remove non-directory or empty directory at path, if it exists"""
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+
+        if e.errno != errno.EISDIR:
+            raise
+
+        os.rmdir(path)
+
+class Overlay:
+    def __init__(self, src, dst, threads=1):
+        self.src = src
+        self.dst = dst
+        self.threads = threads
+
+        self.chown = (os.geteuid() == 0)
+
+        self.seen = set()
+        self.dirs = []          # (path, st) of copied dirs, attrs set last
+        self.links = []         # (path, first path) hardlinks, linked last
+        self.inodes = {}        # (st_dev, st_ino) -> first path copied
+        self.parents = set()    # destination dirs known to exist
+        self.errors = []        # paths we failed to copy
+
+    def _set_attrs(self, path, st, symlink=False):
+        if self.chown:
+            os.lchown(path, st.st_uid, st.st_gid)
+
+        # symlink modes are meaningless (and python has no lchmod)
+        if symlink:
+            _lutime(path, st.st_atime, st.st_mtime)
+            return
+
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+    def _error(self, path, e):
+        print >> sys.stderr, "warning: can't copy %s: %s" % (path, e.strerror or e)
+
+        # list.append is atomic so copy threads can share this without a lock
+        self.errors.append(path)
+
+    def _copy_file(self, src, dst, st):
+        try:
+            _copy_data(src, dst)
+            self._set_attrs(dst, st)
+        except EnvironmentError, e:
+            self._error(dst, e)
+
+    def _mkparents(self, path):
+        parent = dirname(path)
+        if parent in self.parents:
+            return
+
+        if not isdir(parent):
+            os.makedirs(parent)
+
+        self.parents.add(parent)
+
+    def _copy(self, pool, relpath):
+        if relpath in self.seen:
+            return
+        self.seen.add(relpath)
+
+        src = join(self.src, relpath)
+        dst = join(self.dst, relpath)
+
+        try:
+            st = os.lstat(src)
+        except OSError:
+            return
+
+        try:
+            self._mkparents(dst)
+            if stat.S_ISDIR(st.st_mode):
+                if islink(dst) or not isdir(dst):
+                    _unlink(dst)
+                    os.mkdir(dst)
+
+                fnames = sorted(os.listdir(src))
+            else:
+                self._copy_nondir(pool, src, dst, st)
+                return
+
+        except EnvironmentError, e:
+            self._error(dst, e)
+            return
+
+        self.dirs.append((dst, st))
+        self.parents.add(dst)
+
+        for fname in fnames:
+            self._copy(pool, join(relpath, fname))
+
+    def _copy_nondir(self, pool, src, dst, st):
+        if stat.S_ISSOCK(st.st_mode):
+            return
+
+        _unlink(dst)
+
+        if st.st_nlink > 1:
+            inode = (st.st_dev, st.st_ino)
+            if inode in self.inodes:
+                self.links.append((dst, self.inodes[inode]))
+                return
+
+            self.inodes[inode] = dst
+
+        if stat.S_ISREG(st.st_mode):
+            if pool:
+                pool.submit(self._copy_file, src, dst, st)
+            else:
+                self._copy_file(src, dst, st)
+
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+            self._set_attrs(dst, st, symlink=True)
+
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+            self._set_attrs(dst, st)
+
+    def __call__(self, paths):
+        pool = ThreadPool(self.threads, maxsize=self.threads * 2) \
+               if self.threads > 1 else None
+        try:
+            for path in paths:
+                path = path.strip('/')
+                if path:
+                    self._copy(pool, path)
+        finally:
+            if pool:
+                pool.join()
+
+        for dst, first in self.links:
+            try:
+                os.link(first, dst)
+            except OSError, e:
+                self._error(dst, e)
+
+        # deepest first so that setting a directory's attributes comes
+        # after everything beneath it has been created
+        for dst, st in reversed(self.dirs):
+            try:
+                self._set_attrs(dst, st)
+            except OSError, e:
+                self._error(dst, e)
+
+        if self.errors:
+            paths = sorted(self.errors)
+            raise Error("failed to copy %d paths: %s%s" % (len(paths), ", ".join(paths[:10]),
+                                                           ", ..." if len(paths) > 10 else ""))
+
+def apply(src, dst, paths, threads=1):
+    """Copy relative <paths> from <src> onto <dst>"""
+    Overlay(src, dst, threads)(paths)
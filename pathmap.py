@@ -12,6 +12,13 @@ import glob
 from os.path import *
 
 class PathMap(dict):
+    """Maps paths to True (included) or False (excluded).
+
+    A path's membership is decided by its nearest mapped ancestor (or
+    itself). Paths are also stored in a trie of path components so that
+    lookups cost O(depth) instead of a dict probe per dirname().
+    """
+
     @staticmethod
     def _expand(path):
         def needsglob(path):
@@ -39,18 +46,41 @@ class PathMap(dict):
             for expanded in self._expand(path):
                 self[expanded] = sign
 
+        self._includes = [ path for path in self if self[path] ]
+        self._excludes = frozenset([ path for path in self if not self[path] ])
+
+        # each trie node is a dict of path components -> child nodes. The
+        # None key holds the sign of the path ending at that node
+        self._trie = {}
+        for path, sign in self.items():
+            # we never look up the root itself (see __contains__)
+            if path == '/':
+                continue
+
+            node = self._trie
+            for part in path.split('/'):
+                node = node.setdefault(part, {})
+            node[None] = sign
+
     def includes(self):
-        return [ path for path in self if self[path] ]
+        return self._includes
     includes = property(includes)
 
     def excludes(self):
-        return [ path for path in self if not self[path] ]
+        """set of explicitly excluded paths"""
+        return self._excludes
     excludes = property(excludes)
 
     def __contains__(self, path):
-        while path not in ('', '/'):
-            if dict.__contains__(self, path):
-                return self[path]
-            path = dirname(path)
+        sign = self.default
+
+        node = self._trie
+        for part in path.split('/'):
+            node = node.get(part)
+            if node is None:
+                break
+
+            if None in node:
+                sign = node[None]
 
-        return self.default
+        return sign
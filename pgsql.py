@@ -13,15 +13,32 @@ import os
 from os.path import *
 
 import re
+import pwd
+import errno
 import commands
 import shutil
+import time
+import tempfile
+import threading
 
-from executil import system, getoutput, getoutput_popen
+from executil import system, getoutput, getoutput_popen, ExecError
 
 from dblimits import DBLimits
+from threadpool import ThreadPool
 
 FNAME_GLOBALS = ".globals.sql"
 FNAME_MANIFEST = "manifest.txt"
+FNAME_MARKER = "marker"
+FNAME_WAL = ".wal"
+
+# pg_stat_database counters are flushed asynchronously. PostgreSQL 15+
+# defers flushing pending stats for up to a minute under contention, and
+# older versions may drop updates altogether, so this isn't a hard bound
+STATS_FLUSH_SECONDS = 60
+
+# first line of the manifest of a non-tar format dump
+# (tar format manifests list extracted files)
+MANIFEST_FORMAT = "format="
 
 class Error(Exception):
     pass
@@ -38,14 +55,81 @@ def list_databases():
         name = m.group(1)
         yield name
 
-def dumpdb(outdir, name, tlimits=[]):
+def _chown_tree(path, uid, gid):
+    os.chown(path, uid, gid)
+    for dirpath, dnames, fnames in os.walk(path):
+        for fname in dnames + fnames:
+            os.lchown(join(dirpath, fname), uid, gid)
+
+def chown_postgres(path):
+    """recursively give <path> to the postgres user"""
+    pw = pwd.getpwnam('postgres')
+    _chown_tree(path, pw.pw_uid, pw.pw_gid)
+
+def _postgres_test(expr):
+    try:
+        getoutput(su("test " + expr))
+        return True
+    except ExecError:
+        return False
+
+def is_postgres_readable(path):
+    return _postgres_test("-r" + commands.mkarg(path))
+
+def postgres_tempdir(path):
+    """Returns a new temporary directory owned by postgres that it can
+    reach. If possible the directory is on the same filesystem as <path>
+    so files can be renamed between them instead of copied"""
+    dev = os.stat(path).st_dev
+
+    candidates = [ tempfile.gettempdir() ]
+    parent = dirname(abspath(path))
+    while True:
+        candidates.append(parent)
+        if parent == '/':
+            break
+        parent = dirname(parent)
+
+    for dir in candidates:
+        if os.stat(dir).st_dev == dev and _postgres_test("-x" + commands.mkarg(dir)):
+            tmpdir = tempfile.mkdtemp(prefix="tklbam-pgsql-", dir=dir)
+            break
+    else:
+        tmpdir = tempfile.mkdtemp(prefix="tklbam-pgsql-")
+
+    chown_postgres(tmpdir)
+    return tmpdir
+
+def read_manifest(dbdump):
+    """Returns (format, files) of the dump in <dbdump>"""
+    manifest = file(join(dbdump, FNAME_MANIFEST)).read().splitlines()
+    if manifest and manifest[0].startswith(MANIFEST_FORMAT):
+        return manifest[0][len(MANIFEST_FORMAT):], manifest[1:]
+
+    # remove any malformed entries
+    return 'tar', [i for i in manifest if not i.endswith('Permission denied')]
+
+def dumpdb(outdir, name, tlimits=[], jobs=1):
+    """Dump database <name> to <outdir>/<name>. If <jobs> > 1 the database
+    is dumped in directory format by <jobs> concurrent connections,
+    otherwise in tar format"""
     path = join(outdir, name)
     if isdir(path):
         shutil.rmtree(path)
-    os.makedirs(path)
+
+    # pg_dump runs as postgres which can't reach into a private outdir
+    # (e.g., /TKLBAM), so a directory format dump is written elsewhere
+    # and then moved into place
+    tmpdir = None
 
     # format pg_dump command
-    pg_dump = "pg_dump --format=tar"
+    if jobs > 1:
+        tmpdir = postgres_tempdir(outdir)
+        pg_dump = "pg_dump --format=directory --jobs=%d --file=%s" % (jobs, join(tmpdir, name))
+    else:
+        os.makedirs(path)
+        pg_dump = "pg_dump --format=tar"
+
     for (table, sign) in tlimits:
         if sign:
             pg_dump += " --table=" + table
@@ -53,49 +137,291 @@ def dumpdb(outdir, name, tlimits=[]):
             pg_dump += " --exclude-table=" + table
     pg_dump += " " + name
 
-    manifest = getoutput(su(pg_dump) + " | tar xvC %s" % path)
+    if tmpdir:
+        try:
+            system(su(pg_dump))
+            shutil.move(join(tmpdir, name), path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        _chown_tree(path, os.getuid(), os.getgid())
+        manifest = MANIFEST_FORMAT + "directory\n" + "\n".join(sorted(os.listdir(path)))
+    else:
+        manifest = getoutput(su(pg_dump) + " | tar xvC %s" % path)
+
     file(join(path, FNAME_MANIFEST), "w").write(manifest + "\n")
 
-def restoredb(dbdump, dbname, tlimits=[]):
-    manifest = file(join(dbdump, FNAME_MANIFEST)).read().splitlines()
-    # remove any malformed entries
-    manifest = [i for i in manifest if not i.endswith('Permission denied')]
+def _pg_restore(dbname, command):
+    # pg_restore exits with an error after errors it ignored (e.g., objects
+    # that already exist), which psql used to swallow. It reports them.
+    try:
+        system(command)
+    except ExecError:
+        print >> sys.stderr, "warning: pg_restore reported errors restoring " + dbname
+
+def restoredb(dbdump, dbname, tlimits=[], jobs=1):
+    format, files = read_manifest(dbdump)
+    if format not in ('tar', 'directory'):
+        raise Error("unsupported format of %s dump (%s)" % (dbname, format))
+
     try:
         getoutput(su("dropdb " + dbname))
     except:
         pass
 
-    orig_cwd = os.getcwd()
-    os.chdir(dbdump)
+    table_opts = ""
+    for (table, sign) in tlimits:
+        if sign:
+            table_opts += " --table=" + table
+
+    # an extracted tar format dump is a valid directory format dump, so
+    # both are restored from the directory, with jobs
+    pg_restore = "cd $HOME; pg_restore --create --dbname=postgres --format=directory" + table_opts
+
+    # the dump is given to postgres for the duration of the restore
+    owners = [ (dbdump, os.lstat(dbdump)) ]
+    for dirpath, dnames, fnames in os.walk(dbdump):
+        for fname in dnames + fnames:
+            path = join(dirpath, fname)
+            owners.append((path, os.lstat(path)))
 
+    tmpdir = None
     try:
-        command = "tar c %s 2>/dev/null" % " ".join(manifest)
-        command += " | pg_restore --create --dbname=postgres --format=tar"
-        for (table, sign) in tlimits:
-            if sign:
-                command += " --table=" + table
-        command += " | " + su("cd $HOME; psql")
-        system(command)
+        chown_postgres(dbdump)
+
+        # pg_restore reads the dump as postgres, which may not be able
+        # to reach into a private extract directory. If so we move the
+        # dump somewhere it can for the duration of the restore.
+        if not is_postgres_readable(join(dbdump, "toc.dat")):
+            tmpdir = postgres_tempdir(dbdump)
+
+            path = join(tmpdir, dbname)
+            shutil.move(dbdump, path)
+
+            # a move across filesystems creates a copy owned by us
+            chown_postgres(path)
+        else:
+            path = dbdump
+
+        try:
+            _pg_restore(dbname, su("%s --jobs=%d %s" % (pg_restore, jobs, path)))
+        finally:
+            if tmpdir:
+                shutil.move(path, dbdump)
+                shutil.rmtree(tmpdir)
 
     finally:
-        os.chdir(orig_cwd)
+        for path, st in owners:
+            os.lchown(path, st.st_uid, st.st_gid)
+
+def psql_query(sql):
+    """Returns rows of <sql> query as lists of values"""
+    output = getoutput(su("psql -q -A -t -F '\t' -d postgres -c" + commands.mkarg(sql)))
+    return [ line.split('\t') for line in output.splitlines() ]
+
+def change_markers():
+    """Returns {dbname: marker} where a database's marker changes with any
+    write to it.
+
+    Markers are pg_stat_database's cumulative row counters, which
+    aggregate n_tup_ins/upd/del of all the database's tables including
+    its catalogs. Shared catalogs (e.g., ALTER DATABASE, roles) are
+    counted apart, so their counters are part of every marker. Without
+    track_counts the counters don't move and we have no markers.
+    """
+    if psql_query("SHOW track_counts") != [ [ 'on' ] ]:
+        return {}
+
+    counters = {}
+    for row in psql_query("SELECT datname, tup_inserted, tup_updated, tup_deleted, stats_reset "
+                          "FROM pg_stat_database"):
+        counters[row[0]] = " ".join(row[1:])
+
+    shared = counters.pop('', None)
+    return dict([ (dbname, "%s\nshared %s" % (val, shared))
+                  for dbname, val in counters.items() ])
+
+def wal_position():
+    """Returns the current WAL position of the cluster, which moves with
+    any write to it, or None if we can't tell (e.g., on a standby)"""
+    # pg_current_xlog_location was renamed in PostgreSQL 10
+    for function in ("pg_current_wal_lsn()", "pg_current_xlog_location()"):
+        try:
+            return psql_query("SELECT " + function)[0][0]
+        except (ExecError, IndexError):
+            continue
+
+    return None
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy(src, dst)
+
+class PgFSCache:
+    """Database dumps from a previous backup, with their change markers.
+
+    Dump files are hardlinked between the cache and pgfs, which is safe
+    because dumpdb always dumps into a new directory.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def marker(self, dbname):
+        """Returns marker of cached dump of <dbname> or None"""
+        try:
+            return file(join(self.path, dbname, FNAME_MARKER)).read()
+        except IOError:
+            return None
+
+    def get(self, dbname, marker):
+        """Returns path of cached dump of <dbname> if its marker matches"""
+        if self.marker(dbname) != marker:
+            return None
+
+        return join(self.path, dbname)
 
-def pgsql2fs(outdir, limits=[], callback=None):
+    def wal(self):
+        """Returns WAL position of the cluster when the cache was dumped"""
+        try:
+            return file(join(self.path, FNAME_WAL)).read()
+        except IOError:
+            return None
+
+    @staticmethod
+    def link(src, dst):
+        if isdir(dst):
+            shutil.rmtree(dst)
+        os.makedirs(dst)
+
+        for fname in os.listdir(src):
+            _link(join(src, fname), join(dst, fname))
+
+    def update(self, pgfs, wal=None):
+        """Replace cache with the dumps in <pgfs> that have markers, dumped
+        at WAL position <wal>"""
+        tmp = self.path + ".tmp"
+        if exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        if wal:
+            file(join(tmp, FNAME_WAL), "w").write(wal)
+
+        for dbname in os.listdir(pgfs):
+            path = join(pgfs, dbname)
+            if exists(join(path, FNAME_MARKER)):
+                self.link(path, join(tmp, dbname))
+
+        if exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp, self.path)
+
+def pgsql2fs(outdir, limits=[], callback=None, threads=1, jobs=1, cache=None):
+    """Dump databases within <limits> to <outdir>, up to <threads>
+    databases concurrently, each with <jobs> pg_dump jobs.
+
+    If <cache> is the path of a PgFSCache, databases without writes since
+    they were cached are carried forward from the cache rather than dumped.
+    A database is carried forward if its change marker is unchanged.
+    Unless the WAL position of the cluster hasn't moved either, the marker
+    is checked again once the stats counters should have been flushed (see
+    STATS_FLUSH_SECONDS), in case a write had yet to be counted. This is a
+    best effort: a write the counters miss or only count later (e.g., to
+    an unlogged table, which doesn't move the WAL either) can leave a stale
+    dump carried forward.
+    """
     limits = DBLimits(limits)
 
-    for dbname in list_databases():
-        if dbname not in limits or dbname == 'postgres' or re.match(r'template\d', dbname):
-            continue
+    dbnames = [ dbname for dbname in list_databases()
+                if dbname in limits and dbname != 'postgres' and not re.match(r'template\d', dbname) ]
+
+    # taken before dumping, so writes during the dump change them
+    markers = {}
+    wal = None
+    wal_unchanged = False
+    if cache:
+        cache = PgFSCache(cache)
+        wal = wal_position()
+        wal_unchanged = wal is not None and wal == cache.wal()
+
+        markers_time = time.time()
+        markers = change_markers()
+
+    # databases carried forward while the WAL moved
+    unflushed = []
+
+    def marker_limits(dbname):
+        # a dump with other table limits isn't the same dump
+        return "\nlimits %r\n" % limits[dbname]
+
+    def dump(dbname):
+        marker = markers.get(dbname)
+        if marker:
+            marker += marker_limits(dbname)
+
+            cached = cache.get(dbname, marker)
+            if cached:
+                PgFSCache.link(cached, join(outdir, dbname))
+                if not wal_unchanged:
+                    unflushed.append((dbname, marker))
+                return
+
+        dumpdb(outdir, dbname, limits[dbname], jobs)
+        if marker:
+            file(join(outdir, dbname, FNAME_MARKER), "w").write(marker)
+
+    if threads > 1 and len(dbnames) > 1:
+        lock = threading.Lock()
+
+        def run(dbname):
+            if callback:
+                lock.acquire()
+                try:
+                    callback(dbname)
+                finally:
+                    lock.release()
+
+            dump(dbname)
+
+        pool = ThreadPool(min(threads, len(dbnames)))
+        try:
+            for dbname in dbnames:
+                pool.submit(run, dbname)
+        finally:
+            pool.join()
 
-        if callback:
-            callback(dbname)
+    else:
+        for dbname in dbnames:
+            if callback:
+                callback(dbname)
+
+            dump(dbname)
 
-        dumpdb(outdir, dbname, limits[dbname])
+    if unflushed:
+        delay = markers_time + STATS_FLUSH_SECONDS - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        flushed = change_markers()
+        for dbname, marker in unflushed:
+            if dbname in flushed and flushed[dbname] + marker_limits(dbname) == marker:
+                continue
+
+            dumpdb(outdir, dbname, limits[dbname], jobs)
+            if dbname in flushed:
+                file(join(outdir, dbname, FNAME_MARKER), "w").write(flushed[dbname] + marker_limits(dbname))
 
     globals = getoutput(su("pg_dumpall --globals"))
     file(join(outdir, FNAME_GLOBALS), "w").write(globals)
 
-def fs2pgsql(outdir, limits=[], callback=None):
+    if cache:
+        cache.update(outdir, wal)
+
+def fs2pgsql(outdir, limits=[], callback=None, jobs=1):
     limits = DBLimits(limits)
     for (database, table) in limits.tables:
         if (database, table) not in limits:
@@ -114,7 +440,7 @@ def fs2pgsql(outdir, limits=[], callback=None):
         if callback:
             callback(dbname)
 
-        restoredb(fpath, dbname, limits[dbname])
+        restoredb(fpath, dbname, limits[dbname], jobs)
 
 def cb_print(fh=None):
     if not fh:
@@ -125,7 +451,7 @@ def cb_print(fh=None):
 
     return func
 
-def backup(outdir, limits=[], callback=None):
+def backup(outdir, limits=[], callback=None, threads=1, jobs=1, cache=None):
     if isdir(outdir):
         shutil.rmtree(outdir)
 
@@ -133,15 +459,15 @@ def backup(outdir, limits=[], callback=None):
         os.makedirs(outdir)
 
     try:
-        pgsql2fs(outdir, limits, callback)
+        pgsql2fs(outdir, limits, callback, threads, jobs, cache)
     except Exception, e:
         if isdir(outdir):
             shutil.rmtree(outdir)
         raise Error("pgsql backup failed: " + str(e))
 
-def restore(path, limits=[], callback=None):
+def restore(path, limits=[], callback=None, jobs=1):
     try:
-        fs2pgsql(path, limits, callback=callback)
+        fs2pgsql(path, limits, callback=callback, jobs=jobs)
     except Exception, e:
         raise Error("pgsql restore failed: " + str(e))
 
@@ -67,7 +67,8 @@ Run "tklbam-init --help" for further details.
     class Paths(_Paths):
         files = ['restore.log', 'backup.log', 'backup.pid',
                  'backup-resume', 'sub_apikey', 'secret', 'key', 'credentials', 'hbr',
-                 'profile', 'profile/stamp', 'profile/profile_id']
+                 'profile', 'profile/stamp', 'profile/profile_id',
+                 'dirindex-cache', 'myfs-cache', 'pgfs-cache']
 
     def __init__(self, path=None):
         if path is None:
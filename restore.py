@@ -16,21 +16,22 @@ from os.path import *
 import userdb
 import pkgman
 
-from changes import Changes
+from itertools import chain
+
+from changes import ChangesFile, Executor
 from pathmap import PathMap
 from rollback import Rollback
 
-from utils import AttrDict, fmt_title, apply_overlay
+from utils import AttrDict, fmt_title
 
 import backup
+import overlay
 import conf
 import mysql
 import pgsql
 
 import simplejson
 
-from temp import TempFile
-
 class Error(Exception):
     pass
 
@@ -44,7 +45,10 @@ class Restore:
 
     PACKAGES_BLACKLIST = ['linux-*', 'vmware-tools*']
 
-    def __init__(self, backup_extract_path, limits=[], rollback=True, simulate=False):
+    PROGRESS_INTERVAL = 10000
+
+    def __init__(self, backup_extract_path, limits=[], rollback=True, simulate=False,
+                 threads=1, quiet=False, resume=False):
         self.extras = backup.ExtrasPaths(backup_extract_path)
         if not isdir(self.extras.path):
             raise self.Error("illegal backup_extract_path: can't find '%s'" % self.extras.path)
@@ -56,6 +60,9 @@ class Restore:
                     if exists(self.extras.backup_conf) else None
 
         self.simulate = simulate
+        self.threads = threads
+        self.quiet = quiet
+        self.resume = resume
         self.rollback = Rollback.create() if rollback else None
         self.limits = conf.Limits(limits)
         self.backup_extract_path = backup_extract_path
@@ -72,7 +79,7 @@ class Restore:
             print fmt_title("DATABASE - unserializing MySQL databases from " + self.extras.myfs)
 
             try:
-                mysql.restore(self.extras.myfs, self.extras.etc.mysql,
+                mysql.restore(self.extras.myfs, self.extras.etc.mysql, self.threads, self.resume,
                               limits=self.limits.mydb, callback=mysql.cb_print(), simulate=self.simulate)
 
             except mysql.Error, e:
@@ -87,7 +94,7 @@ class Restore:
                 return
 
             try:
-                pgsql.restore(self.extras.pgfs, self.limits.pgdb, callback=pgsql.cb_print())
+                pgsql.restore(self.extras.pgfs, self.limits.pgdb, callback=pgsql.cb_print(), jobs=self.threads)
 
             except pgsql.Error, e:
                 print "SKIPPING PGSQL DATABASE RESTORE: " + str(e)
@@ -166,14 +173,42 @@ class Restore:
                  for fpath in file(fsdelta_olist_path).read().splitlines() 
                  if fpath in pathmap ] 
 
-    @staticmethod
-    def _apply_overlay(src, dst, olist):
-        tmp = TempFile("fsdelta-olist-")
-        for fpath in olist:
-            print >> tmp, fpath.lstrip('/')
-        tmp.close()
+    def _apply_overlay(self, src, dst, olist):
+        overlay.apply(src, dst, olist, self.threads)
 
-        apply_overlay(src, dst, tmp.path)
+    def _apply_fixes(self, statfixes, deleted):
+        # rollback moves deleted to 'originals'
+        if self.rollback:
+            actions = statfixes
+        else:
+            actions = chain(statfixes, deleted)
+
+        if self.quiet:
+            def callback(action):
+                done = sum(executor.counters.values())
+                if done % self.PROGRESS_INTERVAL == 0:
+                    print "  %d (%s)" % (done, executor.fmt_counters())
+        else:
+            def callback(action):
+                print "  " + str(action)
+
+        executor = Executor(self.threads, callback)
+
+        def skip(actions):
+            for action in actions:
+                executor.counters[action.name] = executor.counters.get(action.name, 0) + 1
+                if not self.quiet:
+                    callback(action)
+
+        if self.simulate:
+            skip(chain(statfixes, deleted))
+        else:
+            executor(actions)
+            if self.rollback:
+                skip(deleted)
+
+        if self.quiet:
+            print "  TOTAL: %s" % executor.fmt_counters()
 
     def files(self):
         extras = self.extras
@@ -199,7 +234,7 @@ class Restore:
 
             print
 
-        changes = Changes.fromfile(extras.fsdelta, limits)
+        changes = ChangesFile(extras.fsdelta, limits)
         deleted = list(changes.deleted())
 
         if rollback:
@@ -208,32 +243,26 @@ class Restore:
         fsdelta_olist = self._get_fsdelta_olist(extras.fsdelta_olist, limits)
         if fsdelta_olist:
             print "OVERLAY:\n"
-            for fpath in fsdelta_olist:
-                print "  " + fpath
+            if self.quiet:
+                print "  %d paths" % len(fsdelta_olist)
+            else:
+                for fpath in fsdelta_olist:
+                    print "  " + fpath
 
             if not simulate:
                 self._apply_overlay(overlay, '/', fsdelta_olist)
 
             print
 
-        statfixes = list(changes.statfixes(uidmap, gidmap))
+        statfixes = changes.statfixes(uidmap, gidmap)
+        first = next(statfixes, None)
 
-        if statfixes or deleted:
+        if first is not None or deleted:
             print "POST-OVERLAY FIXES:\n"
+            if first is not None:
+                statfixes = chain([first], statfixes)
 
-        for action in statfixes:
-            print "  " + str(action)
-            if not simulate:
-                action()
-
-        for action in deleted:
-            print "  " + str(action)
-
-            # rollback moves deleted to 'originals'
-            if not simulate and not rollback:
-                action()
-
-        if statfixes or deleted:
+            self._apply_fixes(statfixes, deleted)
             print
 
         def w(path, s):
@@ -0,0 +1,113 @@
+#!/usr/bin/python2
+"""
+Benchmark fs2mysql SQL generation throughput
+
+Arguments:
+    <myfs>              MyFS tree to generate SQL from
+                        if not specified, a synthetic tree is generated
+
+Options:
+    -t --tables=N       number of tables in synthetic tree (default: 5000)
+    -r --rows=N         number of rows per table (default: 50)
+    -k --keep           keep the synthetic tree
+
+To compare before and after a change, run the benchmark on both revisions.
+"""
+import os
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+
+from os.path import *
+
+sys.path.insert(0, join(dirname(__file__), ".."))
+import mysql
+
+ROW = "INSERT INTO `t%d` VALUES (%d,'%s','lorem ipsum dolor sit amet',NULL,3.14159);\n"
+
+class Sink:
+    """discards everything written, counting bytes"""
+    def __init__(self):
+        self.written = 0
+
+    def write(self, s):
+        self.written += len(s)
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [ -options ] [ myfs ]" % sys.argv[0]
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def generate(path, tables, rows):
+    fh = file(path, "w")
+    for database in range(tables / 1000 + 1):
+        print >> fh, "CREATE DATABASE /*!32312 IF NOT EXISTS*/ `bench%d` /*!40100 DEFAULT CHARACTER SET latin1 */;" % database
+        print >> fh, "USE `bench%d`;" % database
+
+        for table in range(database * 1000, min(tables, (database + 1) * 1000)):
+            print >> fh, "CREATE TABLE `t%d` (\n  `id` int(11) NOT NULL,\n  `a` varchar(32),\n" \
+                         "  `b` text,\n  `c` int(11),\n  `d` double\n) ENGINE=InnoDB;" % table
+
+            for i in range(rows):
+                fh.write(ROW % (table, i, "%032x" % i))
+
+    fh.close()
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 't:r:kh', ['tables=', 'rows=', 'keep', 'help'])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    tables = 5000
+    rows = 50
+    keep = False
+    for opt, val in opts:
+        if opt in ('-t', '--tables'):
+            tables = int(val)
+        elif opt in ('-r', '--rows'):
+            rows = int(val)
+        elif opt in ('-k', '--keep'):
+            keep = True
+        else:
+            usage()
+
+    tmpdir = None
+    try:
+        if args:
+            myfs = args[0]
+        else:
+            tmpdir = tempfile.mkdtemp(prefix="fs2mysql-bench-")
+            myfs = join(tmpdir, "myfs")
+            os.mkdir(myfs)
+
+            print "generating synthetic MyFS with %d tables of %d rows: %s" % (tables, rows, myfs)
+            dump = join(tmpdir, "dump.sql")
+            generate(dump, tables, rows)
+            mysql.mysql2fs(file(dump), myfs)
+            os.remove(dump)
+
+        sink = Sink()
+
+        started = time.time()
+        mysql.fs2mysql(sink, myfs)
+        elapsed = time.time() - started
+
+        mb = sink.written / (1024.0 * 1024)
+        print "generated %.1f MB of SQL in %.2f seconds" % (mb, elapsed)
+        print "%.1f MB/sec" % (mb / elapsed)
+
+    finally:
+        if tmpdir:
+            if keep:
+                print "kept " + tmpdir
+            else:
+                shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python2
+"""
+Benchmark mysql2fs parsing throughput
+
+Arguments:
+    <dump.sql>          mysqldump --skip-extended-insert output to parse
+                        if not specified, a synthetic dump is generated
+
+Options:
+    -s --size=MB        size of synthetic dump (default: 1024)
+    -k --keep           keep the synthetic dump and MyFS output
+"""
+import os
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+
+from os.path import *
+
+sys.path.insert(0, join(dirname(__file__), ".."))
+import mysql
+
+ROW = "INSERT INTO `t%d` VALUES (%d,'%s','lorem ipsum dolor sit amet, consectetur adipiscing elit',NULL,3.14159);\n"
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [ -options ] [ dump.sql ]" % sys.argv[0]
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def generate(path, size):
+    fh = file(path, "w")
+    print >> fh, "CREATE DATABASE /*!32312 IF NOT EXISTS*/ `bench` /*!40100 DEFAULT CHARACTER SET latin1 */;"
+    print >> fh, "USE `bench`;"
+
+    written = 0
+    table = 0
+    while written < size:
+        print >> fh, "CREATE TABLE `t%d` (\n  `id` int(11) NOT NULL,\n  `a` varchar(32),\n" \
+                     "  `b` text,\n  `c` int(11),\n  `d` double\n) ENGINE=InnoDB;" % table
+
+        for i in range(100000):
+            row = ROW % (table, i, "%032x" % i)
+            fh.write(row)
+            written += len(row)
+
+        table += 1
+
+    fh.close()
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 's:kh', ['size=', 'keep', 'help'])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    size = 1024
+    keep = False
+    for opt, val in opts:
+        if opt in ('-s', '--size'):
+            size = int(val)
+        elif opt in ('-k', '--keep'):
+            keep = True
+        else:
+            usage()
+
+    tmpdir = tempfile.mkdtemp(prefix="mysql2fs-bench-")
+    try:
+        if args:
+            dump = args[0]
+        else:
+            dump = join(tmpdir, "dump.sql")
+            print "generating %d MB synthetic dump: %s" % (size, dump)
+            generate(dump, size * 1024 * 1024)
+
+        myfs = join(tmpdir, "myfs")
+        os.mkdir(myfs)
+
+        started = time.time()
+        mysql.mysql2fs(file(dump), myfs)
+        elapsed = time.time() - started
+
+        rows = 0
+        for database in os.listdir(myfs):
+            tables = join(myfs, database, "tables")
+            for table in os.listdir(tables):
+                rows += sum(1 for line in file(join(tables, table, "rows")))
+
+        mb = os.stat(dump).st_size / (1024.0 * 1024)
+        print "parsed %.1f MB, %d rows in %.2f seconds" % (mb, rows, elapsed)
+        print "%d rows/sec, %.1f MB/sec" % (rows / elapsed, mb / elapsed)
+
+    finally:
+        if keep:
+            print "kept " + tmpdir
+        else:
+            shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
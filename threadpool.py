@@ -0,0 +1,81 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Bounded pool of worker threads.
+
+Usage example::
+
+    pool = ThreadPool(8)
+    for path in paths:
+        pool.submit(os.lchown, path, 0, 0)
+
+    pool.join()     # waits for all jobs, re-raises the first exception
+
+Jobs may submit further jobs to the pool they are running in (e.g., a
+directory walker submitting subdirectories). join() only returns once the
+queue has drained and all workers are idle.
+"""
+import sys
+import threading
+from Queue import Queue
+
+class ThreadPool:
+    def __init__(self, threads, maxsize=0):
+        """If <maxsize> is set, submit() blocks while that many jobs are
+        queued. Don't use it with jobs that submit further jobs."""
+        if threads < 1:
+            raise ValueError("illegal number of threads (%d)" % threads)
+
+        self.queue = Queue(maxsize)
+        self.exc_info = None
+
+        self.workers = []
+        for i in range(threads):
+            worker = threading.Thread(target=self._worker)
+            worker.setDaemon(True)
+            worker.start()
+
+            self.workers.append(worker)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+
+            func, args = job
+            try:
+                # after the first error we drain the queue without running jobs
+                if not self.exc_info:
+                    func(*args)
+            except:
+                if not self.exc_info:
+                    self.exc_info = sys.exc_info()
+
+            self.queue.task_done()
+
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+
+    def join(self):
+        """wait for all submitted jobs to finish and stop the workers"""
+        self.queue.join()
+
+        for worker in self.workers:
+            self.queue.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+        if self.exc_info:
+            exc_type, exc_value, exc_tb = self.exc_info
+            raise exc_type, exc_value, exc_tb
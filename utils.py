@@ -13,6 +13,7 @@ from os.path import *
 
 import executil
 import shutil
+import overlay
 import stat
 import datetime
 
@@ -65,13 +66,10 @@ def move(src, dst):
         shutil.move(src, dst)
         os.lchown(dst, st.st_uid, st.st_gid)
 
-def apply_overlay(src, dst, olist_path):
-    orig_cwd = os.getcwd()
-    os.chdir(src)
-    executil.getoutput("tar --create --files-from=%s | tar --extract --directory %s" %
-                       (olist_path, executil.mkarg(dst)))
-
-    os.chdir(orig_cwd)
+def apply_overlay(src, dst, olist_path, threads=1):
+    """Copy paths listed in olist_path (one per line) from src onto dst"""
+    paths = ( line.rstrip("\n") for line in file(olist_path) )
+    overlay.apply(src, dst, paths, threads)
 
 def fmt_title(title, c='='):
     return title + "\n" + c * len(title) + "\n"